@@ -0,0 +1,224 @@
+import threading
+from Communication import findJpegEnd
+
+
+def exifThumbnail(data):
+    """
+    Returns the thumbnail JPEG embedded in the EXIF block at the start of a JPEG, or None if there is none.
+    The EXIF block is the first segment raspistill writes, so only the first bytes of a file are needed, see exifLength.
+
+    :param data:    bytes of the start of a JPEG, up to at least the end of the EXIF block
+    """
+    if data[:4] != b'\xff\xd8\xff\xe1':
+        return None
+    end = min(len(data), 4 + ((data[4] << 8) | data[5]))
+    start = data.find(b'\xff\xd8', 10, end)
+    if start < 0:
+        return None
+    stop = findJpegEnd(data[:end], start)
+    return bytes(data[start:stop]) if stop > 0 else None
+
+
+def exifLength(head):
+    """
+    Returns the number of bytes from the start of a JPEG up to the end of its EXIF block, given its first 6 bytes
+    """
+    if head[:4] != b'\xff\xd8\xff\xe1':
+        return 0
+    return 4 + ((head[4] << 8) | head[5])
+
+
+class Plan:
+    """
+    How the next capture is encoded and delivered.
+    A plan with a thumbnail delivers the EXIF thumbnail first and fetches the untouched original in the background.
+    """
+    def __init__(self, quality=None, size=None, thumbnail=None):
+        """
+        :param quality:     JPEG quality passed as -q, None for the raspistill default
+        :param size:        (width, height) passed as -w/-h, None for full resolution
+        :param thumbnail:   (width, height, quality) of the EXIF thumbnail passed as -th, None for no thumbnail-first delivery
+        """
+        self.quality = quality
+        self.size = size
+        self.thumbnail = thumbnail
+
+    def full(self):
+        """
+        True if the plan leaves the original image as it is
+        """
+        return self.quality is None and self.size is None
+
+    def getArguments(self):
+        """
+        Returns the raspistill arguments of the plan
+        """
+        args = []
+        if self.quality is not None:
+            args.append('-q %d' % self.quality)
+        if self.size is not None:
+            args.append('-w %d -h %d' % self.size)
+        if self.thumbnail is not None:
+            args.append('-th %d:%d:%d' % self.thumbnail)
+        return ' '.join(args)
+
+    def __str__(self):
+        if self.thumbnail is not None:
+            return 'thumbnail %dx%d first' % self.thumbnail[:2]
+        if self.full():
+            return 'full quality'
+        return ' '.join(s for s in ('q%d' % self.quality if self.quality is not None else '',
+                                    '%dx%d' % self.size if self.size is not None else '') if s)
+
+
+class AdaptiveController:
+    """
+    Class choosing how to encode and deliver captures, so that a usable image arrives within a latency budget.
+    Link throughput and the fixed cost of a capture are estimated from the CaptureTimings of recent transfers,
+    and the size of a capture from the bytes per pixel of recent captures at the same quality.
+    By default the original is never reduced: if it can not arrive within the budget, its EXIF thumbnail is delivered first.
+    With lossy set, quality and resolution are lowered instead.
+    A new plan restarts a hot camera, so the plan is only changed for a cheaper one once captures have repeatedly missed the budget
+    or are estimated to miss it by more than MARGIN, and for a richer one only if it fits the budget by MARGIN with the restart included.
+    """
+    # quantised, so that only a clear change of the estimates leads to another plan
+    # the EXIF block holding the thumbnail is limited to 64 kB
+    THUMBNAILS = ((512, 384, 50), (320, 240, 70), (160, 120, 70))
+    QUALITIES = (85, 70, 50, 30)
+    SCALES = (1, 2, 4)
+    # rough size of a JPEG at quality q relative to raspistill's default quality, until it has been measured
+    QUALITY_FACTOR = {85: 0.7, 70: 0.45, 50: 0.3, 30: 0.2}
+    # fraction of the budget by which an estimate has to be off before the plan is changed
+    MARGIN = 0.2
+    # captures over budget in a row after which a cheaper plan is taken, however close they were
+    PATIENCE = 2
+
+    def __init__(self, budget, sensor_size, lossy=False, smoothing=0.3):
+        """
+        :param budget:      seconds from trigger until a usable image is shown
+        :param sensor_size: (width, height) of a full resolution capture
+        :param lossy:       reduce quality and resolution of the original instead of delivering a thumbnail first
+        :param smoothing:   weight of the newest measurement in the moving averages
+        """
+        self.budget = budget
+        self.lossy = lossy
+        self._sensor_size = sensor_size
+        self._smoothing = smoothing
+        self._lock = threading.Lock()
+        self._throughput = None
+        self._overhead = None
+        self._start = None
+        self._misses = 0
+        # bytes per pixel of a typical photo at raspistill's default quality, until it has been measured
+        self._bpp = {None: 0.5}
+        self.last_plan = None
+
+    def _average(self, old, new):
+        return new if old is None else old + self._smoothing * (new - old)
+
+    def record(self, timings, plan=None):
+        """
+        Updates the estimates from the CaptureTimings of a capture or a transfer
+
+        :param plan:    Plan the capture was taken with, None if the timings only hold a transfer
+        """
+        with self._lock:
+            # small transfers are dominated by round trips and would underestimate the link
+            if timings.throughput() is not None and timings.bytes >= 65536:
+                self._throughput = self._average(self._throughput, timings.throughput())
+            if plan is None:
+                return
+            # starting a hot camera is timed as 'start' and only happens when the plan changes, so it is no part of the overhead
+            if 'start' in timings.stages:
+                self._start = self._average(self._start, timings.stages['start'])
+            overhead = sum(seconds for name, seconds in timings.stages.items() if name in ('command', 'exec', 'remote', 'teardown'))
+            self._overhead = self._average(self._overhead, overhead)
+            latency = sum(seconds for name, seconds in timings.stages.items() if name != 'start')
+            self._misses = self._misses + 1 if latency > self.budget else 0
+        if timings.bytes and plan.thumbnail is None:
+            self.recordSize(timings.bytes, plan)
+
+    def recordSize(self, nbytes, plan=None):
+        """
+        Updates the size estimate from the bytes of a capture, e.g. of an original fetched after its thumbnail
+
+        :param plan:    Plan the capture was taken with, None for a full quality original
+        """
+        quality = plan.quality if plan is not None else None
+        size = plan.size if plan is not None else None
+        width, height = size if size is not None else self._sensor_size
+        with self._lock:
+            self._bpp[quality] = self._average(self._bpp.get(quality), nbytes / (width * height))
+
+    def throughput(self):
+        """
+        Estimated link throughput in bytes per second, None before the first transfer
+        """
+        return self._throughput
+
+    def estimate(self, quality=None, size=None):
+        """
+        Estimated bytes of a capture at the given quality and size
+        """
+        width, height = size if size is not None else self._sensor_size
+        bpp = self._bpp.get(quality)
+        if bpp is None:
+            bpp = self._bpp[None] * self.QUALITY_FACTOR.get(quality, 1.0)
+        return bpp * width * height
+
+    def _bytes(self, plan):
+        """
+        Estimated bytes delivered before the image of a plan can be shown
+        """
+        if plan.thumbnail is not None:
+            return plan.thumbnail[0] * plan.thumbnail[1] * 0.25
+        return self.estimate(plan.quality, plan.size)
+
+    def _latency(self, plan):
+        return (self._overhead or 0.0) + self._bytes(plan) / self._throughput
+
+    def plan(self):
+        """
+        Returns the Plan for the next capture
+        """
+        with self._lock:
+            if self._throughput is None:
+                # nothing is lost delivering a thumbnail first, and the background transfer of the original measures the link
+                plan = Plan(thumbnail=self.THUMBNAILS[1])
+            else:
+                fits = lambda candidate: self._latency(candidate) <= self.budget
+                if self.lossy:
+                    candidates = [Plan()] + [Plan(q, (self._sensor_size[0] // s, self._sensor_size[1] // s) if s > 1 else None)
+                                             for s in self.SCALES for q in self.QUALITIES]
+                else:
+                    candidates = [Plan()] + [Plan(thumbnail=t) for t in self.THUMBNAILS]
+                plan = next((c for c in candidates if fits(c)), candidates[-1])
+                current = self.last_plan
+                # the thumbnail taken before the link was measured is no candidate of lossy mode, and is left right away
+                known = current is not None and any(c.getArguments() == current.getArguments() for c in candidates)
+                if known and plan.getArguments() != current.getArguments():
+                    plan = self._settle(current, plan)
+                    if plan is not current:
+                        # the misses were those of the previous plan
+                        self._misses = 0
+            self.last_plan = plan
+            return plan
+
+    def _settle(self, current, plan):
+        """
+        Returns the plan to take instead of current, which is either plan or current itself, see the class description
+        """
+        latency = self._latency(current)
+        if latency <= self.budget:
+            # plan is a richer one, worth a restart only if it fits with room to spare
+            if self._latency(plan) + (self._start or 0.0) <= (1 - self.MARGIN) * self.budget:
+                return plan
+            return current
+        if self._misses >= self.PATIENCE or latency > (1 + self.MARGIN) * self.budget:
+            return plan
+        return current
+
+    def __str__(self):
+        if self._throughput is None:
+            return 'link not measured yet'
+        return '%.0f kB/s, %.2f s overhead, %.2f s start, %s' % (self._throughput / 1000, self._overhead or 0.0, self._start or 0.0, self.last_plan)
@@ -0,0 +1,103 @@
+import math
+import time
+import threading
+import numpy as np
+from PIL import Image
+
+
+class FrameAnalysis:
+    """
+    Exposure and focus statistics of one frame, computed on a decimated array
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.highlights = None
+        self.shadows = None
+        self.highlight_mask = None
+        self.shadow_mask = None
+        self.focus = None
+        self.step = 1
+        self.size = None
+        self.elapsed = None
+
+    def clippingOverlay(self, size, highlight=(255, 0, 0, 160), shadow=(0, 96, 255, 160)):
+        """
+        Returns the clipping masks as a transparent RGBA image scaled to size, for drawing on top of the picture
+        """
+        overlay = np.zeros(self.highlight_mask.shape + (4,), dtype=np.uint8)
+        overlay[self.shadow_mask] = shadow
+        overlay[self.highlight_mask] = highlight
+        return Image.fromarray(overlay, 'RGBA').resize(size, Image.NEAREST)
+
+    def __str__(self):
+        return ('highlights %.2f %%, shadows %.2f %%, focus %.1f (1/%d, %.1f ms)'
+                % (100 * self.highlights, 100 * self.shadows, self.focus, self.step, 1000 * self.elapsed))
+
+
+class Analyser:
+    """
+    Class computing RGB/luma histograms, highlight/shadow clipping masks and a Laplacian variance focus score of captured frames.
+    Frames are decimated by a whole step before the analysis, and the step is chosen from the measured cost per pixel,
+    so the analysis of a frame stays within budget milliseconds whatever its size.
+    The step is only changed when the cost is off by more than a third, so focus scores of consecutive frames stay comparable.
+    """
+    def __init__(self, budget_ms=15, high=250, low=5):
+        """
+        :param budget_ms:   time allowed for the analysis of a frame in milliseconds
+        :param high:        channel value from which a pixel counts as a clipped highlight
+        :param low:         luma value up to which a pixel counts as a clipped shadow
+        """
+        self.budget_ms = budget_ms
+        self.high = high
+        self.low = low
+        self._lock = threading.Lock()
+        self._seconds_per_pixel = None
+        self._step = None
+
+    def _chooseStep(self, pixels):
+        with self._lock:
+            if self._seconds_per_pixel is None:
+                # a first guess for a vectorised pass over uint8 pixels, refined after every frame
+                self._seconds_per_pixel = 40e-9
+            wanted = max(1, int(math.ceil(math.sqrt(pixels * self._seconds_per_pixel / (self.budget_ms / 1000)))))
+            if self._step is None or not 0.75 <= (self._step / wanted) ** 2 <= 1.33:
+                self._step = wanted
+            return self._step
+
+    def _learn(self, pixels, seconds):
+        with self._lock:
+            # per analysed pixel, the cost of a frame is that times its pixels divided by the square of the step
+            per_pixel = seconds / max(1, pixels)
+            self._seconds_per_pixel = per_pixel if self._seconds_per_pixel is None else 0.7 * self._seconds_per_pixel + 0.3 * per_pixel
+
+    def analyse(self, img):
+        """
+        Analyses a PIL image, e.g. a display rendition from CapturedImage.rendition, and returns a FrameAnalysis
+        """
+        t0 = time.perf_counter()
+        step = self._chooseStep(img.size[0] * img.size[1])
+        if step > 1:
+            # nearest neighbour only reads the pixels it keeps, unlike converting the whole image to an array and slicing it
+            img = img.resize((max(1, img.size[0] // step), max(1, img.size[1] // step)), Image.NEAREST)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        rgb = np.asarray(img)
+        res = FrameAnalysis()
+        res.step = step
+        res.size = (rgb.shape[1], rgb.shape[0])
+        # integer Rec. 601 luma, exact enough for histograms and a lot cheaper than floats
+        luma = ((rgb[..., 0].astype(np.uint16) * 77 + rgb[..., 1].astype(np.uint16) * 150 + rgb[..., 2].astype(np.uint16) * 29) >> 8).astype(np.uint8)
+        for i, name in enumerate(('red', 'green', 'blue')):
+            res.histograms[name] = np.bincount(rgb[..., i].ravel(), minlength=256)
+        res.histograms['luma'] = np.bincount(luma.ravel(), minlength=256)
+        res.highlight_mask = (rgb >= self.high).any(axis=2)
+        res.shadow_mask = luma <= self.low
+        n = luma.size
+        res.highlights = np.count_nonzero(res.highlight_mask) / n
+        res.shadows = np.count_nonzero(res.shadow_mask) / n
+        y = luma.astype(np.float32)
+        lap = 4 * y[1:-1, 1:-1] - y[:-2, 1:-1] - y[2:, 1:-1] - y[1:-1, :-2] - y[1:-1, 2:]
+        res.focus = float(lap.var()) if lap.size else 0.0
+        res.elapsed = time.perf_counter() - t0
+        self._learn(n, res.elapsed)
+        return res
@@ -0,0 +1,156 @@
+import os
+import io
+import json
+import base64
+import shutil
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+
+class CaptureArchive:
+    """
+    Class keeping the captures of a session in a directory instead of deleting them.
+    Every frame is appended to index.jsonl with its time, options, command, size and a small JPEG thumbnail,
+    so a filmstrip can be shown from the index alone, without opening or decoding any capture.
+    Frames are numbered from 0 in the order they are added and looked up by number in a list.
+    Disk use is bounded by evicting the least recently used captures. The index is only ever appended to:
+    an eviction is another line, and the frame keeps its metadata and thumbnail.
+    """
+    INDEX = 'index.jsonl'
+
+    def __init__(self, directory, max_bytes=2000 * 10**6, thumbnail_size=(160, 120)):
+        """
+        :param directory:       directory of the archive, created if missing. An existing archive is continued.
+        :param max_bytes:       disk space the captures may take, the least recently used are deleted beyond it
+        :param thumbnail_size:  size the thumbnails in the index are fitted into
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        self._lock = threading.Lock()
+        self._frames = []
+        # frame number -> bytes of the capture on disk, least recently used first
+        self._resident = OrderedDict()
+        self._bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        path = os.path.join(self.directory, self.INDEX)
+        if not os.path.isfile(path):
+            return
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                if entry.get('evicted'):
+                    if entry['frame'] < len(self._frames):
+                        self._frames[entry['frame']]['evicted'] = True
+                    self._resident.pop(entry['frame'], None)
+                elif entry.get('frame') == len(self._frames):
+                    self._frames.append(entry)
+                    if os.path.isfile(os.path.join(self.directory, entry['file'])):
+                        self._resident[entry['frame']] = entry['size']
+                    else:
+                        entry['evicted'] = True
+        self._bytes = sum(self._resident.values())
+
+    def _append(self, entry):
+        with open(os.path.join(self.directory, self.INDEX), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def _thumbnail(self, data):
+        from Display import CapturedImage
+        img = CapturedImage(data).rendition(self.thumbnail_size)
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', quality=70)
+        return buf.getvalue()
+
+    def add(self, source, options=None, command=None, mode=None, time=None):
+        """
+        Adds a capture. A local file is moved into the archive unless it is in there already, bytes are written to it.
+
+        :param source:  path of the captured JPEG or its bytes
+        :param options: dict of the option values it was captured with
+        :param command: command line it was captured with
+        :param mode:    capture mode, see CaptureTimings.mode
+        :param time:    datetime of the capture, defaults to now
+        :return:        frame number
+        """
+        time = time if time is not None else datetime.now()
+        if isinstance(source, (bytes, bytearray)):
+            data = bytes(source)
+        else:
+            with open(source, 'rb') as f:
+                data = f.read()
+        thumbnail = self._thumbnail(data)
+        from PIL import Image
+        size = Image.open(io.BytesIO(data)).size
+        with self._lock:
+            frame = len(self._frames)
+            if isinstance(source, (bytes, bytearray)):
+                name = 'img_' + str(time).replace(" ", "_").replace(":", "-") + '.jpeg'
+                with open(os.path.join(self.directory, name), 'wb') as f:
+                    f.write(data)
+            elif os.path.dirname(os.path.abspath(source)) == os.path.abspath(self.directory):
+                # captured straight into the archive, the file keeps its name
+                name = os.path.basename(source)
+            else:
+                name = os.path.basename(source)
+                shutil.move(source, os.path.join(self.directory, name))
+            entry = {'frame': frame, 'time': time.isoformat(), 'file': name, 'size': len(data),
+                     'width': size[0], 'height': size[1], 'mode': mode, 'command': command, 'options': options or {},
+                     'thumbnail': base64.b64encode(thumbnail).decode('ascii')}
+            self._append(entry)
+            self._frames.append(entry)
+            self._resident[frame] = len(data)
+            self._bytes += len(data)
+            self._evict()
+        return frame
+
+    def _evict(self):
+        """
+        Deletes the least recently used captures until the archive fits max_bytes. The newest capture is always kept.
+        """
+        while self._bytes > self.max_bytes and len(self._resident) > 1:
+            frame, size = self._resident.popitem(last=False)
+            self._bytes -= size
+            entry = self._frames[frame]
+            entry['evicted'] = True
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+            self._append({'frame': frame, 'evicted': True})
+
+    def __len__(self):
+        return len(self._frames)
+
+    def frame(self, number):
+        """
+        Returns the index entry of a frame: a dict with time, file, size, width, height, mode, command, options and thumbnail
+        """
+        return self._frames[number]
+
+    def path(self, number):
+        """
+        Returns the path of the capture of a frame and marks it as recently used, or None if it has been evicted
+        """
+        with self._lock:
+            if number not in self._resident:
+                return None
+            self._resident.move_to_end(number)
+            return os.path.join(self.directory, self._frames[number]['file'])
+
+    def thumbnail(self, number):
+        """
+        Returns the JPEG bytes of the thumbnail of a frame
+        """
+        return base64.b64decode(self._frames[number]['thumbnail'])
+
+    def diskUsage(self):
+        return self._bytes
@@ -0,0 +1,583 @@
+"""
+End-to-end benchmark of the capture paths against a local stand-in for the RPi.
+
+The stand-in is a paramiko ssh/SFTP server running in its own process, with fake raspistill and raspivid
+executables which serve a synthetic JPEG of a configurable size after a simulated capture delay.
+The link bandwidth of the stand-in can be limited. Every case runs in a fresh client process,
+so the peak RSS reported is that of the case alone.
+
+    python Benchmark.py --sizes 2028x1520,4056x3040 --bandwidths 0,20e6 --modes file,hot,stream --save baseline.json
+    python Benchmark.py --sizes 2028x1520,4056x3040 --bandwidths 0,20e6 --modes file,hot,stream --baseline baseline.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+
+USER = 'pi'
+PSWD = 'raspberry'
+# cameras of the fleet benchmark mode
+FLEET_CAMERAS = 4
+
+FAKE_RASPISTILL = '''#!{python}
+import io, os, sys, time, struct
+
+args = sys.argv[1:]
+
+def opt(name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+out = opt('-o')
+width = opt('-w')
+height = opt('-h')
+verbose = '-v' in args
+jpeg = open(os.environ['FAKE_JPEG'], 'rb').read()
+quality = opt('-q')
+thumbnail = opt('-th', '64:48:35')
+if (width is not None and height is not None) or quality is not None:
+    from PIL import Image
+    img = Image.open(io.BytesIO(jpeg))
+    if width is not None and height is not None:
+        img = img.resize((int(width), int(height)))
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=int(quality or 85))
+    jpeg = buf.getvalue()
+if thumbnail != 'none':
+    # like raspistill, put an EXIF block holding a thumbnail right after the start of image marker
+    from PIL import Image
+    w, h, q = [int(v) for v in thumbnail.split(':')]
+    buf = io.BytesIO()
+    Image.open(io.BytesIO(jpeg)).resize((w, h)).save(buf, 'JPEG', quality=q)
+    th = buf.getvalue()
+    tiff = (b'II*\\x00' + struct.pack('<IHI', 8, 0, 14) + struct.pack('<H', 2) + struct.pack('<HHII', 0x0201, 4, 1, 44)
+            + struct.pack('<HHII', 0x0202, 4, 1, len(th)) + struct.pack('<I', 0) + th)
+    app1 = b'Exif\\x00\\x00' + tiff
+    # a thumbnail too large for a JPEG segment is left out
+    if len(app1) + 2 <= 0xffff:
+        jpeg = jpeg[:2] + b'\\xff\\xe1' + struct.pack('>H', len(app1) + 2) + app1 + jpeg[2:]
+delay = float(os.environ.get('FAKE_CAPTURE_DELAY', '0'))
+close_delay = float(os.environ.get('FAKE_CLOSE_DELAY', '0.05'))
+
+def log(line):
+    if verbose:
+        sys.stderr.write(line + '\\n')
+        sys.stderr.flush()
+
+def capture(frame):
+    time.sleep(delay)
+    if out == '-':
+        sys.stdout.buffer.write(jpeg)
+        sys.stdout.buffer.flush()
+        log('Finished capture %d' % frame)
+        return
+    name = out % frame if '%' in out else out
+    f = open(name + '~', 'wb')
+    f.write(jpeg)
+    log('Finished capture %d' % frame)
+    # like raspistill, the file is only closed and renamed after reporting the capture
+    time.sleep(close_delay)
+    f.close()
+    os.rename(name + '~', name)
+
+time.sleep(float(os.environ.get('FAKE_STARTUP_DELAY', '0')))
+if '-k' in args:
+    frame = 0
+    while True:
+        log('Press Enter to capture, X then ENTER to exit')
+        line = sys.stdin.readline()
+        if not line or line.strip().lower() == 'x':
+            break
+        frame += 1
+        capture(frame)
+else:
+    capture(1)
+'''
+
+FAKE_RASPIVID = '''#!{python}
+import os, sys, time, io
+from PIL import Image
+
+args = sys.argv[1:]
+
+def opt(name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+buf = io.BytesIO()
+img = Image.open(open(os.environ['FAKE_JPEG'], 'rb'))
+img.draft('RGB', (int(opt('-w', 640)), int(opt('-h', 480))))
+img.resize((int(opt('-w', 640)), int(opt('-h', 480)))).save(buf, 'JPEG', quality=70)
+frame = buf.getvalue()
+period = 1.0 / float(opt('-fps', 30))
+time.sleep(float(os.environ.get('FAKE_STARTUP_DELAY', '0')))
+while True:
+    t0 = time.time()
+    sys.stdout.buffer.write(frame)
+    sys.stdout.buffer.flush()
+    time.sleep(max(0.0, period - (time.time() - t0)))
+'''
+
+
+def syntheticJpeg(size, quality=90):
+    """
+    Returns a JPEG of the given size with enough texture to compress like a real photo
+    """
+    from PIL import Image, ImageFilter
+    img = Image.effect_noise((size[0] // 4, size[1] // 4), 64).resize(size, Image.BICUBIC).convert('RGB')
+    img = img.filter(ImageFilter.DETAIL)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+class ThrottledSocket:
+    """
+    Socket wrapper limiting the bytes per second sent, used on the server side to simulate a slow link
+    """
+    def __init__(self, sock, bandwidth):
+        self._sock = sock
+        self._bandwidth = bandwidth
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def send(self, data):
+        n = self._sock.send(data)
+        if self._bandwidth:
+            with self._lock:
+                self._next = max(self._next, time.time()) + n / self._bandwidth
+                delay = self._next - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return n
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while len(view):
+            view = view[self.send(view):]
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def _makeStubServer(root):
+    """
+    Creates the paramiko server interfaces of the stand-in. paramiko is only needed when serving.
+    """
+    import paramiko
+
+    def real(path):
+        if path.startswith('~'):
+            path = root + path[1:]
+        if not os.path.isabs(path):
+            path = os.path.join(root, path)
+        return os.path.normpath(path)
+
+    class Handle(paramiko.SFTPHandle):
+        def stat(self):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+    class SFTPStub(paramiko.SFTPServerInterface):
+        def canonicalize(self, path):
+            return real(path)
+
+        def list_folder(self, path):
+            try:
+                return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(real(path), name)), name)
+                        for name in os.listdir(real(path))]
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def stat(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.stat(real(path)))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        lstat = stat
+
+        def open(self, path, flags, attr):
+            try:
+                fd = os.open(real(path), flags | getattr(os, 'O_BINARY', 0), 0o644)
+                mode = 'ab' if flags & os.O_APPEND else ('r+b' if flags & os.O_RDWR else ('wb' if flags & os.O_WRONLY else 'rb'))
+                f = os.fdopen(fd, mode)
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            handle = Handle(flags)
+            handle.filename = real(path)
+            handle.readfile = f
+            handle.writefile = f
+            return handle
+
+        def remove(self, path):
+            try:
+                os.remove(real(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def rename(self, oldpath, newpath):
+            try:
+                os.rename(real(oldpath), real(newpath))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        posix_rename = rename
+
+        def mkdir(self, path, attr):
+            try:
+                os.mkdir(real(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def rmdir(self, path):
+            try:
+                os.rmdir(real(path))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            return paramiko.SFTP_OK
+
+        def chattr(self, path, attr):
+            return paramiko.SFTP_OK
+
+    class Server(paramiko.ServerInterface):
+        def __init__(self, env):
+            self._env = env
+
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL if (username, password) == (USER, PSWD) else paramiko.AUTH_FAILED
+
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_exec_request(self, channel, command):
+            threading.Thread(target=_serveExec, args=(channel, command.decode(), root, self._env), daemon=True).start()
+            return True
+
+    return paramiko, SFTPStub, Server
+
+
+def _serveExec(channel, command, root, env):
+    """
+    Runs an exec request in a local shell, wiring its stdin/stdout/stderr to the channel
+    """
+    proc = subprocess.Popen(['sh', '-c', command], cwd=root, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def pump(src, send):
+        try:
+            for chunk in iter(lambda: src.read1(65536), b''):
+                send(chunk)
+        except (OSError, EOFError):
+            proc.kill()
+
+    def feed():
+        try:
+            for chunk in iter(lambda: channel.recv(65536), b''):
+                proc.stdin.write(chunk)
+                proc.stdin.flush()
+            proc.stdin.close()
+        except (OSError, EOFError, ValueError):
+            pass
+
+    threads = [threading.Thread(target=pump, args=(proc.stdout, channel.sendall), daemon=True),
+               threading.Thread(target=pump, args=(proc.stderr, channel.sendall_stderr), daemon=True)]
+    for t in threads:
+        t.start()
+    threading.Thread(target=feed, daemon=True).start()
+    status = proc.wait()
+    for t in threads:
+        t.join()
+    try:
+        # killed by a signal, reported as a shell would
+        channel.send_exit_status(status if status >= 0 else 128 - status)
+        channel.close()
+    except (OSError, EOFError):
+        pass
+
+
+def serve(jpeg_path, bandwidth=0.0, capture_delay=0.0, startup_delay=0.0):
+    """
+    Runs the stand-in until stdin is closed. Prints 'PORT <port> ROOT <dir>' once it accepts connections.
+    """
+    root = tempfile.mkdtemp(prefix='fakepi_')
+    paramiko, SFTPStub, Server = _makeStubServer(root)
+    bindir = os.path.join(root, '.bin')
+    os.makedirs(bindir)
+    os.makedirs(os.path.join(root, 'experiments'))
+    for name, script in (('raspistill', FAKE_RASPISTILL), ('raspivid', FAKE_RASPIVID)):
+        pth = os.path.join(bindir, name)
+        with open(pth, 'w') as f:
+            f.write(script.replace('{python}', sys.executable))
+        os.chmod(pth, 0o755)
+    env = dict(os.environ, PATH=bindir + os.pathsep + os.environ.get('PATH', ''), HOME=root, FAKE_JPEG=jpeg_path,
+               FAKE_CAPTURE_DELAY=str(capture_delay), FAKE_STARTUP_DELAY=str(startup_delay))
+    key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+
+    def accept():
+        while True:
+            sock, _ = listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(ThrottledSocket(sock, bandwidth))
+            transport.add_server_key(key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SFTPStub)
+            transport.start_server(server=Server(env))
+
+    threading.Thread(target=accept, daemon=True).start()
+    print('PORT %d ROOT %s' % (listener.getsockname()[1], root), flush=True)
+    sys.stdin.read()
+    shutil.rmtree(root, ignore_errors=True)
+
+
+class StandIn:
+    """
+    Starts a stand-in RPi in a separate process
+    """
+    def __init__(self, jpeg, bandwidth=0.0, capture_delay=0.0, startup_delay=0.0):
+        self._jpeg = tempfile.NamedTemporaryFile(suffix='.jpeg', delete=False)
+        self._jpeg.write(jpeg)
+        self._jpeg.close()
+        cmd = [sys.executable, os.path.abspath(__file__), '--serve', self._jpeg.name, '--bandwidth', str(bandwidth),
+               '--delay', str(capture_delay), '--startup', str(startup_delay)]
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        _, port, _, root = self._proc.stdout.readline().split(' ', 3)
+        self.port = int(port)
+        self.root = root.strip()
+        self.jpeg = self._jpeg.name
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+        os.remove(self._jpeg.name)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else None
+
+
+def _captureCase(port, root, n, budget=None, **kwargs):
+    from Communication import RaspiStillCommClass
+    cam = RaspiStillCommClass('127.0.0.1', USER, PSWD, root, port=port, **kwargs)
+    cam.local_dir = tempfile.mkdtemp(prefix='bench_')
+    cam.setAdaptive(budget)
+    latencies = []
+    moved = 0
+    try:
+        cam.capture()  # warm up, e.g. start the hot camera
+        for _ in range(n):
+            t0 = time.perf_counter()
+            cam.capture()
+            latencies.append(time.perf_counter() - t0)
+            moved += cam.last_timings.bytes or 0
+        # originals fetched in the background are part of the cost of adaptive mode, but not of its latency
+        cam.waitForOriginals()
+    finally:
+        cam.stopHotCamera()
+        shutil.rmtree(cam.local_dir, ignore_errors=True)
+    return latencies, moved
+
+
+def _burstCase(port, root, n):
+    from Communication import RaspiStillCommClass
+    cam = RaspiStillCommClass('127.0.0.1', USER, PSWD, root, port=port)
+    local_dir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        report = cam.burst(n, local_dir=local_dir)
+        moved = sum(os.path.getsize(pth) for pth in report.frames)
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+    return [report.elapsed / max(1, len(report.frames))] * len(report.frames), moved
+
+
+def _previewCase(port, root, n):
+    from Communication import RaspiStillCommClass
+    cam = RaspiStillCommClass('127.0.0.1', USER, PSWD, root, port=port)
+    stream = cam.startPreview(640, 480, fps=30)
+    latencies = []
+    last, t0 = 0, time.perf_counter()
+    try:
+        while len(latencies) < n:
+            count, _ = stream.latestFrame()
+            if count != last:
+                t1 = time.perf_counter()
+                latencies.append(t1 - t0)
+                last, t0 = count, t1
+            elif not stream.running():
+                raise Exception('Preview stopped')
+            time.sleep(0.001)
+        moved = int(stream.bandwidth() * sum(latencies))
+    finally:
+        stream.stop()
+    return latencies, moved
+
+
+def _runCameraCase(port, root, n):
+    if shutil.which('sshpass') is None:
+        raise RuntimeError('skipped: sshpass not found')
+    import runCamera
+    handler = runCamera.FotoHandler('127.0.0.1', USER, PSWD, None, port=port,
+                                    ssh_options='-q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null')
+    latencies = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        handler._takeFoto()
+        latencies.append(time.perf_counter() - t0)
+    return latencies, n * os.path.getsize(handler._img_path)
+
+
+def _fleetCase(case, cameras):
+    """
+    Rig captures with CameraFleet on the stand-in of the case and cameras - 1 more started like it, each on its own port.
+    The latency is that of a whole rig capture.
+    """
+    from Fleet import CameraFleet
+    with open(case['jpeg'], 'rb') as f:
+        jpeg = f.read()
+    standins = []
+    local_dir = tempfile.mkdtemp(prefix='bench_')
+    fleet = None
+    latencies = []
+    moved = 0
+    try:
+        for _ in range(cameras - 1):
+            standins.append(StandIn(jpeg, case['bandwidth'], case['delay'], case['startup']))
+        hosts = [('127.0.0.1', port, USER, PSWD) for port in [case['port']] + [s.port for s in standins]]
+        # the workspace of every stand-in, relative to its own root
+        fleet = CameraFleet(hosts, 'experiments', local_dir=local_dir)
+        failed = [res for res in fleet.connect().values() if not res.ok()]
+        if failed:
+            raise Exception('Connecting failed: ' + ', '.join(str(res) for res in failed))
+        fleet.capture()  # warm up, i.e. start the hot cameras
+        for _ in range(case['n']):
+            res = fleet.capture()
+            if res.failed():
+                raise Exception(str(res))
+            latencies.append(res.elapsed)
+            moved += len(jpeg) * len(res.results)
+    finally:
+        if fleet is not None:
+            fleet.close()
+        for standin in standins:
+            standin.close()
+        shutil.rmtree(local_dir, ignore_errors=True)
+    return latencies, moved
+
+
+MODES = {
+    'file': lambda case: _captureCase(case['port'], case['root'], case['n']),
+    'hot': lambda case: _captureCase(case['port'], case['root'], case['n'], hot=True),
+    'stream': lambda case: _captureCase(case['port'], case['root'], case['n'], stream=True),
+    'hot-stream': lambda case: _captureCase(case['port'], case['root'], case['n'], hot=True, stream=True),
+    'hot-adaptive': lambda case: _captureCase(case['port'], case['root'], case['n'], budget=1.0, hot=True),
+    'burst': lambda case: _burstCase(case['port'], case['root'], case['n']),
+    'preview': lambda case: _previewCase(case['port'], case['root'], case['n']),
+    'runCamera': lambda case: _runCameraCase(case['port'], case['root'], case['n']),
+    'fleet': lambda case: _fleetCase(case, FLEET_CAMERAS),
+}
+
+
+def runClient(case):
+    """
+    Runs one benchmark case in this process and returns its statistics
+    """
+    import resource
+    t0 = time.perf_counter()
+    try:
+        latencies, moved = MODES[case['mode']](case)
+    except Exception as e:
+        return dict(case, error=str(e))
+    elapsed = time.perf_counter() - t0
+    return dict(case, p50=_percentile(latencies, 50), p95=_percentile(latencies, 95), max=max(latencies),
+                mean=sum(latencies) / len(latencies), per_minute=60 * len(latencies) / sum(latencies),
+                bytes=moved, mb_per_s=moved / elapsed / 1e6,
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def _caseKey(res):
+    return '%s %s %.0f' % (res['mode'], res['size'], res['bandwidth'])
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark capture paths against a local stand-in RPi')
+    parser.add_argument('--sizes', default='1014x760,2028x1520,4056x3040', help='Comma separated image sizes')
+    parser.add_argument('--bandwidths', default='0,10e6', help='Comma separated link bandwidths in bytes/s, 0 is unlimited')
+    parser.add_argument('--modes', default='file,hot,stream,hot-stream,burst', help='Comma separated from ' + ','.join(MODES))
+    parser.add_argument('-n', type=int, default=10, help='Captures per case')
+    parser.add_argument('--delay', type=float, default=0.1, help='Simulated capture time in seconds')
+    parser.add_argument('--startup', type=float, default=1.0, help='Simulated camera start time in seconds')
+    parser.add_argument('--save', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed relative p50 regression against the baseline')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--bandwidth', type=float, default=0.0, help=argparse.SUPPRESS)
+    parser.add_argument('--client', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.bandwidth, args.delay, args.startup)
+        return 0
+    if args.client:
+        print(json.dumps(runClient(json.loads(args.client))))
+        return 0
+
+    results = []
+    for size in args.sizes.split(','):
+        w, h = (int(v) for v in size.split('x'))
+        jpeg = syntheticJpeg((w, h))
+        for bandwidth in (float(b) for b in args.bandwidths.split(',')):
+            standin = StandIn(jpeg, bandwidth, args.delay, args.startup)
+            try:
+                for mode in args.modes.split(','):
+                    case = dict(mode=mode, size=size, jpeg_bytes=len(jpeg), bandwidth=bandwidth, n=args.n,
+                                port=standin.port, root=standin.root, jpeg=standin.jpeg, delay=args.delay, startup=args.startup)
+                    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--client', json.dumps(case)],
+                                         stdout=subprocess.PIPE, universal_newlines=True)
+                    res = json.loads(out.stdout.strip().splitlines()[-1]) if out.returncode == 0 else dict(case, error='client crashed')
+                    results.append(res)
+                    if 'error' in res:
+                        print('%-28s %s' % (_caseKey(res), res['error']), flush=True)
+                    else:
+                        print('%-28s p50 %7.3f s  p95 %7.3f s  %6.1f /min  %6.2f MB/s  rss %5.0f MB'
+                              % (_caseKey(res), res['p50'], res['p95'], res['per_minute'], res['mb_per_s'], res['peak_rss_mb']),
+                              flush=True)
+            finally:
+                standin.close()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    failed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {_caseKey(res): res for res in json.load(f) if 'error' not in res}
+        for res in results:
+            base = baseline.get(_caseKey(res))
+            if base is None or 'error' in res:
+                continue
+            change = res['p50'] / base['p50'] - 1
+            if change > args.threshold:
+                failed = True
+                print('REGRESSION %s: p50 %.3f s vs %.3f s (%+.0f%%)' % (_caseKey(res), res['p50'], base['p50'], 100 * change))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
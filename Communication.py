@@ -1,67 +1,484 @@
 
-import paramiko
 import Options as op
 import os
+import io
+import re
+import json
+import itertools
+import select
+import socket
+import time
+import hashlib
+import queue
+import threading
 from datetime import datetime
 import logging
+from Metrics import CaptureTimings
+
+def findJpegEnd(data, start=0):
+    """
+    Returns the index just past the end of the JPEG starting at start, or -1 if data does not hold all of it yet.
+    Segments are skipped by their length, so the end marker of an embedded EXIF thumbnail is not mistaken for the end.
+
+    :param data:    bytes or bytearray
+    :param start:   index of the start of image marker
+    """
+    n = len(data)
+    pos = start + 2
+    while pos + 1 < n:
+        if data[pos] != 0xFF:
+            raise ValueError('Invalid JPEG data at byte ' + str(pos))
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xD9:
+            return pos + 2
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            pos += 2
+            continue
+        if pos + 3 >= n:
+            return -1
+        pos += 2 + ((data[pos + 2] << 8) | data[pos + 3])
+        if marker == 0xDA:
+            # entropy coded data: the next marker is the first 0xFF not followed by a stuffed 0x00 or a restart marker
+            while True:
+                pos = data.find(b'\xff', pos)
+                if pos < 0 or pos + 1 >= n:
+                    return -1
+                if data[pos + 1] == 0x00 or 0xD0 <= data[pos + 1] <= 0xD7:
+                    pos += 2
+                    continue
+                break
+    return -1
+
+
+class CommandResult:
+    """
+    Outcome of a command run on remote
+    """
+    def __init__(self, command):
+        self.command = command
+        self.exit_status = None
+        self.timed_out = False
+        self.stdout = b''
+        self.stderr = ''
+        self.exec_time = None   # seconds until the command was started on remote
+        self.runtime = None     # seconds from then until it exited
+
+    def ok(self):
+        return not self.timed_out and self.exit_status == 0
+
+    def __str__(self):
+        if self.timed_out:
+            state = 'timed out after %.1f s' % self.runtime
+        else:
+            state = 'exited with status %s after %.1f s' % (self.exit_status, self.runtime)
+        return '`' + self.command + '` ' + state
+
+
+class RemoteCommandError(Exception):
+    """
+    Raised when a command on remote fails or times out
+    """
+    def __init__(self, result):
+        tail = result.stderr.strip().splitlines()[-3:]
+        super().__init__(str(result) + (': ' + ' | '.join(tail) if tail else ''))
+        self.result = result
+
+
+class SshSettings:
+    """
+    Keepalive, retry and tuning settings of the ssh transport of a BaseCommClass.
+    A larger window and packet size help on a slow or high latency link, compression helps when the link rather than the RPi CPU
+    is the bottleneck, and restricting ciphers to a cheap one (e.g. aes128-ctr) helps when the RPi CPU is.
+    """
+    def __init__(self, keepalive=10, keepalive_count=3, connect_timeout=10, io_timeout=30, retries=3, backoff=1.0,
+                 window_size=None, max_packet_size=None, compress=False, ciphers=None):
+        """
+        :param keepalive:       seconds between keepalive packets, 0 disables keepalives
+        :param keepalive_count: number of unanswered TCP keepalive probes after which the link is considered lost
+        :param connect_timeout: seconds to wait for the TCP connection and the ssh banner
+        :param io_timeout:      seconds an SFTP transfer may stall before the link is considered lost, None waits forever
+        :param retries:         number of times a connection or an operation on a lost link is retried
+        :param backoff:         seconds to wait before the first retry, doubled for every following one
+        :param window_size:     ssh channel window size in bytes, None for the paramiko default
+        :param max_packet_size: ssh channel max packet size in bytes, None for the paramiko default
+        :param compress:        compress the ssh transport
+        :param ciphers:         names of the ciphers allowed, None allows all ciphers supported by paramiko
+        """
+        self.keepalive = keepalive
+        self.keepalive_count = keepalive_count
+        self.connect_timeout = connect_timeout
+        self.io_timeout = io_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.compress = compress
+        self.ciphers = ciphers
+
 
 class BaseCommClass:
     """
     Class for handling communication between RPi and host.
-    An object of this class manages an ssh connection along with SFTP file transfer between host and RPi
+    An object of this class manages an ssh connection along with SFTP file transfer between host and RPi.
+    A lost connection is detected through keepalives and transparently reopened, see reconnect.
     """
-    def __init__(self, ip, user, pswd, remote_dir, log=None):
+    def __init__(self, ip, user, pswd, remote_dir, log=None, port=22, connect=True, settings=None):
         """
-        :param log:     If set True the remote log will be written rpi_stdout and rpi_stderr
+        :param log:         If set True the remote log will be written rpi_stdout and rpi_stderr
+        :param port:        ssh port of the RPi
+        :param connect:     If set False the connection is not opened until connect is called
+        :param settings:    SshSettings, defaults to SshSettings()
         """
-        self._ssh = paramiko.SSHClient()
-        self._ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            self._ssh.connect(hostname=ip, username=user, password=pswd)
-        except ConnectionError:
-            raise Exception('Could not connect to Raspberry Pi.')
-        self._sftp = self._ssh.open_sftp()
-        self._sftp.chdir(remote_dir)
+        self._ip = ip
+        self._user = user
+        self._pswd = pswd
+        self._port = port
+        self._ssh = None
+        self._sftp = None
         self._rpi_stdout = None
         self._rpi_stderr = None
         self._remote_dir = remote_dir
-        if log is not None:
+        self.command_timeout = 60
+        self.transfer_requests = 64
+        self.verify_transfers = False
+        self.settings = settings if settings is not None else SshSettings()
+        self._reconnect_lock = threading.Lock()
+        self._retrying = threading.local()
+        if log:
             logging.basicConfig(filename=__name__ + '.log', format='%(asctime)s %(message)s', filemode='w')
             self._logger = logging.getLogger()
             self._logger.setLevel(logging.DEBUG)
         else:
             self._logger = None
+        if connect:
+            self.connect()
+
+    def connect(self):
+        """
+        Opens the ssh connection and the SFTP session. paramiko is imported here, as importing it is slow.
+        Failed attempts are retried settings.retries times with exponential backoff, except when the login is refused.
+        """
+        import paramiko
+        settings = self.settings
+        disabled = None
+        if settings.ciphers:
+            unknown = [c for c in settings.ciphers if c not in paramiko.Transport._preferred_ciphers]
+            if unknown:
+                raise Exception('Unsupported ciphers: ' + ', '.join(unknown))
+            disabled = {'ciphers': [c for c in paramiko.Transport._preferred_ciphers if c not in settings.ciphers]}
+        attempt = 0
+        while True:
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                ssh.connect(hostname=self._ip, port=self._port, username=self._user, password=self._pswd,
+                            timeout=settings.connect_timeout, banner_timeout=settings.connect_timeout,
+                            compress=settings.compress, disabled_algorithms=disabled)
+                break
+            except paramiko.AuthenticationException as e:
+                ssh.close()
+                raise Exception('Could not log in to Raspberry Pi: ' + str(e))
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                ssh.close()
+                if attempt >= settings.retries:
+                    raise ConnectionError('Could not connect to Raspberry Pi at %s:%d: %s' % (self._ip, self._port, e))
+                if self._logger is not None:
+                    self._logger.warning('connecting to %s failed (%s), retrying' % (self._ip, e))
+                time.sleep(settings.backoff * 2 ** attempt)
+                attempt += 1
+        transport = ssh.get_transport()
+        # channels opened from here on, the SFTP session included, use these sizes
+        if settings.window_size is not None:
+            transport.default_window_size = settings.window_size
+        if settings.max_packet_size is not None:
+            transport.default_max_packet_size = settings.max_packet_size
+        if settings.keepalive:
+            transport.set_keepalive(settings.keepalive)
+            self._setTcpKeepalive(transport.sock)
+        sftp = ssh.open_sftp()
+        sftp.get_channel().settimeout(settings.io_timeout)
+        sftp.chdir(self._remote_dir)
+        self._ssh = ssh
+        self._sftp = sftp
+
+    def _setTcpKeepalive(self, sock):
+        """
+        ssh keepalives go unanswered on a dead link without raising, so let the kernel probe the peer and fail the socket instead
+        """
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in (('TCP_KEEPIDLE', self.settings.keepalive), ('TCP_KEEPINTVL', self.settings.keepalive),
+                            ('TCP_KEEPCNT', self.settings.keepalive_count),
+                            ('TCP_USER_TIMEOUT', 1000 * self.settings.keepalive * self.settings.keepalive_count)):
+            if hasattr(socket, name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+    def connected(self):
+        return self._ssh is not None
+
+    def close(self):
+        """
+        Closes the SFTP session and the ssh connection
+        """
+        ssh, sftp = self._ssh, self._sftp
+        self._ssh = None
+        self._sftp = None
+        if sftp is not None:
+            sftp.close()
+        if ssh is not None:
+            ssh.close()
+
+    def reconnect(self):
+        """
+        Closes the connection and opens it again, e.g. after the link was lost. The SFTP session is back in remote_dir afterwards,
+        and all other state of the object, e.g. camera options, is kept.
+        """
+        if self._logger is not None:
+            self._logger.warning('reconnecting to ' + self._ip)
+        try:
+            self.close()
+        except Exception:
+            pass
+        self.connect()
+
+    def _linkLost(self, err):
+        """
+        True if err means the connection was lost rather than that the operation failed
+        """
+        if isinstance(err, (socket.timeout, EOFError, ConnectionError)):
+            return True
+        transport = self._ssh.get_transport() if self._ssh is not None else None
+        return transport is None or not transport.is_active()
+
+    def _withReconnect(self, fn, *args, **kwargs):
+        """
+        Runs fn and, if it failed because the connection was lost, reconnects and runs it again, at most settings.retries times.
+        Nested calls on the same thread run fn once and leave the retrying to the outermost call.
+        """
+        if getattr(self._retrying, 'active', False):
+            return fn(*args, **kwargs)
+        self._retrying.active = True
+        try:
+            attempt = 0
+            while True:
+                ssh = self._ssh
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    if attempt >= self.settings.retries or not self._linkLost(e):
+                        raise
+                    if self._logger is not None:
+                        self._logger.warning('lost connection to %s (%s)' % (self._ip, e))
+                attempt += 1
+                with self._reconnect_lock:
+                    # another thread may have reconnected already
+                    if self._ssh is ssh:
+                        self.reconnect()
+        finally:
+            self._retrying.active = False
 
-    
     def __del__(self):
-        self._ssh.close()
-        self._sftp.close()
+        try:
+            self.close()
+        except Exception:
+            pass
 
-    def _runCommand(self, command, stdin=None):
+    def _execute(self, command, stdin=None, timeout=None, on_stdout=None, on_stderr=None, check=True):
         """
-        Runs a command on the remote machine from the remote_dir and logs if requested
+        Runs a command on the remote machine from the remote_dir and waits for it to exit.
+        stdout and stderr are drained concurrently as data arrives, so neither can stall the remote process,
+        and complete lines are passed on to the logger as they come in.
+        If the connection is lost, it is reopened and the command run again.
 
         :param command:     Command to run on remote machine
-        :param stdin:       Command to pass to stdin on remote if needed
+        :param stdin:       Data to pass to stdin on remote if needed. stdin is closed afterwards.
+        :param timeout:     Seconds to wait for the command to exit, defaults to command_timeout. None waits forever.
+        :param on_stdout:   Called with every chunk of stdout as bytes. If given, stdout is neither kept nor logged.
+        :param on_stderr:   Called with every complete line of stderr
+        :param check:       Raise RemoteCommandError if the command fails
+        :return:            CommandResult
+        """
+        return self._withReconnect(self._executeOnce, command, stdin, timeout, on_stdout, on_stderr, check)
+
+    def _executeOnce(self, command, stdin=None, timeout=None, on_stdout=None, on_stderr=None, check=True):
         """
-        cmd = 'cd ' + self._remote_dir + '; ' + command + ';'
-        ssh_stdin, ssh_stdout, ssh_stderr = self._ssh.exec_command(cmd)
+        Runs a command once, see _execute
+        """
+        timeout = self.command_timeout if timeout is None else timeout
+        res = CommandResult(command)
+        t0 = time.perf_counter()
+        channel = self._ssh.get_transport().open_session()
+        channel.exec_command('cd ' + self._remote_dir + '; ' + command)
+        res.exec_time = time.perf_counter() - t0
         if stdin is not None:
-            ssh_stdin.channel.send(stdin)
-        if self._logger is not None:
-            self._logger.debug(ssh_stdout.read().decode(encoding='UTF-8'))
-            self._logger.critical(ssh_stderr.read().decode(encoding='UTF-8'))        
-    
-    def _get(self, remote_pth, local_pth):
+            channel.sendall(stdin)
+        channel.shutdown_write()
+        deadline = None if not timeout else time.perf_counter() + timeout
+        out = []
+        lines = {'stdout': '', 'stderr': ''}
+        err = []
+
+        def feed(stream, text, callback=None):
+            lines[stream] += text
+            complete = lines[stream].split('\n')
+            lines[stream] = complete.pop()
+            for line in complete:
+                if self._logger is not None:
+                    self._logger.log(logging.DEBUG if stream == 'stdout' else logging.CRITICAL, line)
+                if callback is not None:
+                    callback(line)
+
+        try:
+            while True:
+                while channel.recv_ready():
+                    data = channel.recv(65536)
+                    if on_stdout is not None:
+                        on_stdout(data)
+                    else:
+                        out.append(data)
+                        feed('stdout', data.decode(encoding='UTF-8', errors='replace'))
+                while channel.recv_stderr_ready():
+                    text = channel.recv_stderr(65536).decode(encoding='UTF-8', errors='replace')
+                    err.append(text)
+                    feed('stderr', text, on_stderr)
+                drained = not channel.recv_ready() and not channel.recv_stderr_ready()
+                # the exit status can overtake the last of stdout, only EOF says that all of it has arrived
+                if drained and channel.eof_received and channel.exit_status_ready():
+                    break
+                if drained and channel.closed and not channel.eof_received:
+                    raise ConnectionError('Lost connection to Raspberry Pi while running: ' + command)
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    res.timed_out = True
+                    break
+                wait = 0.1 if remaining is None else min(remaining, 0.1)
+                if channel.eof_received:
+                    # nothing but the exit status is coming, and the fileno stays readable after EOF
+                    channel.status_event.wait(wait)
+                else:
+                    # the channel's fileno becomes readable when stdout or stderr data arrives or the channel closes
+                    select.select([channel], [], [], wait)
+            if not res.timed_out:
+                res.exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        if lines['stdout']:
+            feed('stdout', '\n')
+        if lines['stderr']:
+            feed('stderr', '\n', on_stderr)
+        res.runtime = time.perf_counter() - t0 - res.exec_time
+        res.stdout = b''.join(out)
+        res.stderr = ''.join(err)
+        if check and not res.ok():
+            raise RemoteCommandError(res)
+        return res
+
+    def _runCommand(self, command, stdin=None, timeout=None, timings=None, check=True):
         """
-        Get a file from remote to local
+        Runs a command on the remote machine from the remote_dir, waits for it to finish and logs if requested.
+        See _execute.
+
+        :param command:     Command to run on remote machine
+        :param stdin:       Command to pass to stdin on remote if needed
+        :param timeout:     Seconds to wait for the command to exit, defaults to command_timeout
+        :param timings:     CaptureTimings to record the 'exec' and 'remote' stages in. 
+                            For raspistill in verbose mode 'remote' ends at the 'Finished capture' line, 
+                            and the time until the process has exited is recorded as 'teardown'.
+        :return:            CommandResult
+        """
+        finished = []
+        on_stderr = lambda line: finished.append(time.perf_counter()) if line.startswith('Finished capture') else None
+        t0 = time.perf_counter()
+        res = self._execute(command, stdin, timeout, on_stderr=on_stderr, check=check)
+        if timings is not None:
+            timings.add('exec', res.exec_time)
+            if finished:
+                timings.add('remote', finished[0] - t0 - res.exec_time)
+                timings.add('teardown', t0 + res.exec_time + res.runtime - finished[0])
+            else:
+                timings.add('remote', res.runtime)
+        return res
+
+    def _get(self, remote_pth, local_pth, timings=None, progress=None, own_session=False):
+        """
+        Get a file from remote to local.
+        The file is read with transfer_requests SFTP requests in flight, so large files are limited by the link rather than by the request round trip.
+        Data goes to local_pth + '.part' first, and if the connection is lost the transfer resumes from the bytes already received.
+        The size of the result is always checked, and its sha256 against sha256sum on remote if verify_transfers is set.
 
         :param remote_pth:  path on remote
         :param local_pth:   path on local machine
+        :param timings:     CaptureTimings to record the 'transfer' stage and the number of bytes in
+        :param progress:    called with (bytes received, total bytes) as the transfer goes on
+        :param own_session: transfer through an SFTP session of its own, for transfers running alongside others
+        """
+        t0 = time.perf_counter()
+        part = local_pth + '.part'
+        if os.path.isfile(part):
+            os.remove(part)
+        try:
+            size = self._withReconnect(self._getPart, remote_pth, part, progress, own_session)
+            received = os.path.getsize(part)
+            if received != size:
+                raise Exception('Transfer of %s incomplete: %d of %d bytes' % (remote_pth, received, size))
+            if self.verify_transfers:
+                self._verify(remote_pth, part)
+        except Exception:
+            if self._logger is not None:
+                self._logger.critical('Could not copy ' + remote_pth + ' to ' + local_pth + ' using Paramiko SFTP client.')
+            if os.path.isfile(part):
+                os.remove(part)
+            raise
+        os.replace(part, local_pth)
+        if timings is not None:
+            timings.add('transfer', time.perf_counter() - t0)
+            timings.bytes = size
+
+    def _getPart(self, remote_pth, part, progress=None, own_session=False):
+        """
+        Appends what is missing of a remote file to the partial local file part and returns the size of the remote file
         """
-        self._sftp.get(remote_pth, local_pth)
-        if not os.path.isfile(local_pth) and self._logger is not None:
-            self._logger.critical('Could not copy ' + remote_pth + ' to ' + local_pth + ' using Paramiko SFTP client.')
+        if own_session:
+            sftp = self._ssh.open_sftp()
+            sftp.get_channel().settimeout(self.settings.io_timeout)
+            sftp.chdir(self._remote_dir)
+            try:
+                return self._getPartFrom(sftp, remote_pth, part, progress)
+            finally:
+                sftp.close()
+        return self._getPartFrom(self._sftp, remote_pth, part, progress)
+
+    def _getPartFrom(self, sftp, remote_pth, part, progress):
+        size = sftp.stat(remote_pth).st_size
+        done = os.path.getsize(part) if os.path.isfile(part) else 0
+        if done > size:
+            # the remote file was replaced by a smaller one
+            os.remove(part)
+            done = 0
+        chunk = 32768
+        with sftp.open(remote_pth, 'rb') as rf, open(part, 'ab') as lf:
+            chunks = [(offset, min(chunk, size - offset)) for offset in range(done, size, chunk)]
+            for data in rf.readv(chunks, self.transfer_requests):
+                lf.write(data)
+                done += len(data)
+                if progress is not None:
+                    progress(done, size)
+        return size
+
+    def _verify(self, remote_pth, local_pth):
+        """
+        Compares the sha256 of a local file with the one of its original on remote
+        """
+        res = self._execute('sha256sum ' + remote_pth)
+        remote = res.stdout.decode(encoding='UTF-8', errors='replace').split(' ', 1)[0].strip()
+        digest = hashlib.sha256()
+        with open(local_pth, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        if digest.hexdigest() != remote:
+            raise Exception('Checksum of ' + remote_pth + ' does not match after transfer.')
 
     def _put(self, remote_pth, local_pth):
         """
@@ -70,26 +487,81 @@ class BaseCommClass:
         :param remote_pth:  path on remote
         :param local_pth:   path on local machine
         """    
-        self._sftp.put(local_pth, remote_pth)
+        self._withReconnect(lambda: self._sftp.put(local_pth, remote_pth))
 
 
 class RaspiStillCommClass(BaseCommClass):
     """
     Class for run raspistill on RPi
     """
-    def __init__(self, ip, user, pswd, remote_dir, log=False):
-        super().__init__(ip, user, pswd, remote_dir, log)
+    def __init__(self, ip, user, pswd, remote_dir, log=False, hot=False, stream=False, port=22, connect=True, settings=None):
+        """
+        :param hot:     If set True raspistill is kept running on remote between captures (see setHotCamera)
+        :param stream:  If set True captured images are piped over ssh into memory (see setStreaming)
+        """
+        super().__init__(ip, user, pswd, remote_dir, log, port, connect=False, settings=settings)
         self._options = self._generateDefaultOptions()
         self._local_img = None        
         self._remote_img = 'img.jpeg'
+        self._hot = hot
+        self._hot_channel = None
+        self._hot_cmd = None
+        self._hot_to_stdout = False
+        self._hot_stderr = ''
+        self._hot_stdout = bytearray()
+        self._hot_frames = 0
+        self._hot_prompts = 0
+        self.hot_timeout = 30
+        self._stream = stream
+        self._img_bytes = None
+        self.local_dir = None
+        self.last_timings = None
+        self.preview_bits_per_pixel = 0.5
+        self.sensor_size = (4056, 3040)
+        self._roi = None
+        self._roi_size = None
+        self._adaptive = None
+        self._plan = None
+        self._adaptive_prefix = None
+        self._adaptive_count = 0
+        self._original_img = None
+        self._originals = queue.Queue()
+        self._fetcher = None
+        self._fetch_lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+        self.on_original = None
+        self.failed_originals = []
+        self._archive = None
+        self._last_command = None
+        self.last_frame = None
+        if connect:
+            self.connect()
 
     def __del__(self):
-        if self._remote_img is not None:
-            self._sftp.remove(self._remote_img)
-        if self._local_img is not None:
+        try:
+            self.stopHotCamera()
+        except Exception:
+            pass
+        if self._ssh is not None and self._remote_img is not None and not self._streaming():
+            try:
+                self._sftp.remove(self._remote_img)
+            except IOError:
+                pass
+        if self.last_frame is None and self._local_img is not None and os.path.isfile(self._local_img):
             os.remove(self._local_img)
         super().__del__()
 
+    def close(self):
+        """
+        Stops the hot camera and closes the connection
+        """
+        try:
+            self.stopHotCamera()
+        except Exception:
+            pass
+        super().close()
+
     def _generateDefaultOptions(self):
         """
         Generates the default options for running Raspistill on remote
@@ -97,6 +569,7 @@ class RaspiStillCommClass(BaseCommClass):
         res = []
         fi = lambda cmd, name, descr, lb, ub, d: res.append( op.IntOption(cmd, name, descr, lb, ub, d) ) 
         fg = lambda cmd, name, descr, ran, d: res.append( op.GenericOption(cmd, name, descr, ran, d) ) 
+        ff = lambda cmd, name, descr, d: res.append( op.FlagOption(cmd, name, descr, d) ) 
         fi("-sh", "sharpness", "Set image sharpness", -100, 100, 0)
         fi( "-co", "contrast", "Set image contrast", -100, 100, 0 )
         fi( "-br", "brightness", "Set image brightness", 0, 100, 50 )
@@ -115,11 +588,13 @@ class RaspiStillCommClass(BaseCommClass):
         fg("-rot", "rotation", "Set image rotation", [0, 90, 180, 270], 0)
         #f("-hf", "hflip", "Set horizontal flip", [0, 1], 0)
         #f("-vf", "vflip", "Set vertical flip", [0, 1], 0)
-        # Currently roi is not dealt with because it requires a quadruple of numbers
+        # roi requires a quadruple of numbers and is set through setRoi instead
         # f("-roi", "roi", "Set region of interest (x,y,w,d as normalised coordinates [0.0-1.0])
         # f("-ss", "shutter", "Set shutter speed in microseconds", (0, 200000000)
         # -awbg, --awbgains	: Set AWB gains - AWB mode must be off
         fg("-drc", "DRC", "Set DRC Level", ["off", "low", "med", "high"], "off")
+        # adds the raw Bayer data to the JPEG, about 18 MB on the HQ camera. See Raw.toDng
+        ff("-r", "raw", "Add raw Bayer data to the JPEG", "off")
         #-st, --stats	: Force recomputation of statistics on stills capture pass
         #-a, --annotate	: Enable/Set annotate flags or text
         #-3d, --stereo	: Select stereoscopic mode
@@ -132,16 +607,391 @@ class RaspiStillCommClass(BaseCommClass):
         #-fw, --focus	: Draw a window with the focus FoM value on the image.
         return set(res)
 
-    def getCaptureCommand(self):
+    def getCaptureCommand(self, output=None):
         """
         Generates the command for running Raspistill on remove with currently set options.
+
+        :param output:  output file on remote, defaults to remote_img or stdout in streaming mode
         """
         s = " "
-        res = "raspistill -o" + s + self._remote_img + s + "-v"
+        target = output if output is not None else ("-" if self._streaming() else self._remote_img)
+        res = "raspistill -o" + s + target + s + "-v"
         for option in self._options:
-            res += s + option.command + s + str(option.value)
+            args = option.getArguments()
+            if args:
+                res += s + args
+        if self._roi is not None:
+            res += s + "-roi" + s + ",".join("%.4f" % v for v in self._roi)
+            res += s + "-w %d -h %d" % self._roi_size
+        elif self._plan is not None and self._plan.getArguments():
+            res += s + self._plan.getArguments()
         return res
 
+    def setRoi(self, roi, max_size=1024):
+        """
+        Sets the region of interest for the following captures. The region is captured at native sensor resolution,
+        limited to max_size pixels along its longest side, so a focus check only transfers the pixels of the region.
+
+        :param roi:         (x, y, w, h) as normalised sensor coordinates [0.0-1.0], or None for the full frame
+        :param max_size:    maximum width/height of the captured image in pixels
+        """
+        if roi is None:
+            self._roi = None
+            self._roi_size = None
+            return
+        x, y, w, h = [min(max(float(v), 0.0), 1.0) for v in roi]
+        w = max(min(w, 1.0 - x), 1e-3)
+        h = max(min(h, 1.0 - y), 1e-3)
+        width = w * self.sensor_size[0]
+        height = h * self.sensor_size[1]
+        factor = min(1.0, max_size / max(width, height))
+        self._roi = (x, y, w, h)
+        self._roi_size = (max(16, int(factor * width)), max(16, int(factor * height)))
+
+    def getRoi(self):
+        return self._roi
+
+    def roiFromDisplay(self, roi):
+        """
+        Converts a region of interest in normalised coordinates of a displayed (rotated) image into sensor coordinates,
+        taking the rotation option into account.
+        """
+        x, y, w, h = roi
+        rot = 0
+        for option in self._options:
+            if option.command == "-rot":
+                rot = int(option.value)
+        if rot == 90:
+            return y, 1.0 - x - w, h, w
+        if rot == 180:
+            return 1.0 - x - w, 1.0 - y - h, w, h
+        if rot == 270:
+            return 1.0 - y - h, x, h, w
+        return x, y, w, h
+
+    def captureRoi(self, roi, max_size=1024):
+        """
+        Captures only a region of interest, see setRoi. The region is reset to the full frame afterwards.
+        """
+        self.setRoi(roi, max_size)
+        try:
+            self.capture()
+        finally:
+            self.setRoi(None)
+
+    def getHotCaptureCommand(self, output=None):
+        """
+        Generates the command for a long-lived raspistill on remote with currently set options.
+        raspistill is started in keypress mode and captures a frame each time a newline is sent to its stdin.
+
+        :param output:  output file on remote, see getCaptureCommand
+        """
+        return self.getCaptureCommand(output) + " -k -t 0"
+
+    def rawEnabled(self):
+        """
+        True if the raw Bayer data is added to captured images
+        """
+        return any(isinstance(option, op.FlagOption) and option.command == '-r' and option.value == 'on' for option in self._options)
+
+    def _streaming(self):
+        """
+        True if images are piped over ssh. Raw captures are too large to be held in memory and always go through a file,
+        as do thumbnail-first captures, whose original is kept on remote until it has been fetched.
+        """
+        return self._stream and not self.rawEnabled() and not self._thumbnailFirst()
+
+    def _thumbnailFirst(self):
+        return self._plan is not None and self._plan.thumbnail is not None
+
+    def setAdaptive(self, budget, lossy=False):
+        """
+        Turns adaptive mode on or off.
+        In adaptive mode the encoding of each capture is chosen from the measured link throughput, so a usable image arrives within budget seconds.
+        If the original can not make it in time, its EXIF thumbnail is delivered first and the original is fetched in the background
+        while no capture is running, see getOriginalPath and on_original. With lossy set, quality and resolution are lowered instead.
+        Region of interest captures are never adapted.
+
+        :param budget:  seconds from trigger until an image is delivered, None turns adaptive mode off
+        :param lossy:   reduce quality and resolution of the original instead of delivering a thumbnail first
+        """
+        if budget is None:
+            self._adaptive = None
+            self._plan = None
+            return
+        from Adaptive import AdaptiveController
+        self._adaptive = AdaptiveController(budget, self.sensor_size, lossy)
+
+    def getAdaptiveController(self):
+        return self._adaptive
+
+    def setArchive(self, archive):
+        """
+        Keeps every capture in a CaptureArchive (see Archive.py) instead of deleting the previous one.
+        Captures are transferred straight into the directory of the archive.
+        The number of the last archived frame is in last_frame. Region of interest captures are not archived, they go to local_dir
+        and are deleted by the next capture as without an archive.
+
+        :param archive: CaptureArchive, None to go back to keeping only the last capture
+        """
+        self._archive = archive
+
+    def getArchive(self):
+        return self._archive
+
+    def _captureInfo(self):
+        """
+        Metadata of the last capture for the archive
+        """
+        return {'options': {option.name: option.value for option in self._options}, 'command': self._last_command,
+                'mode': self.last_timings.mode if self.last_timings is not None else None, 'time': datetime.now()}
+
+    def _archiveFrame(self, local_pth, command, mode, settings=None, captured=None):
+        """
+        Adds a frame of a burst or sweep to the archive, if one is set. Returns the path of the frame afterwards.
+
+        :param settings:    option values the frame was captured with on top of the current options
+        :param captured:    time.time() of the capture
+        """
+        if self._archive is None:
+            return local_pth
+        options = {option.name: option.value for option in self._options}
+        options.update(settings or {})
+        self._archive.add(local_pth, options=options, command=command, mode=mode,
+                          time=datetime.fromtimestamp(captured) if captured is not None else None)
+        return os.path.join(self._archive.directory, os.path.basename(local_pth))
+
+    def getOriginalPath(self):
+        """
+        Returns the local path the original of the last capture is fetched to in the background,
+        or None if the last capture was delivered in full
+        """
+        return self._original_img
+
+    def setStreaming(self, stream):
+        """
+        Turns streaming mode on or off.
+        In streaming mode raspistill writes the image to stdout and it is read straight off the ssh channel into memory,
+        so neither a remote nor a local file is written.
+        """
+        self._stream = stream
+
+    def setHotCamera(self, hot):
+        """
+        Turns hot camera mode on or off. 
+        In hot camera mode raspistill is started once and triggered for every capture, 
+        which saves the camera initialisation and preview timeout on each shot.
+        """
+        self._hot = hot
+        if not hot:
+            self.stopHotCamera()
+
+    def startHotCamera(self, output=None):
+        """
+        Starts raspistill in keypress mode on remote. 
+        A running process is only restarted if the options have changed since it was started.
+
+        :param output:  output file on remote, see getCaptureCommand
+        """
+        self._withReconnect(self._startHotCamera, output)
+
+    def hotCameraRunning(self, output=None):
+        """
+        True if the long-lived raspistill is running with the currently set options
+
+        :param output:  output file on remote, see getCaptureCommand
+        """
+        channel = self._hot_channel
+        return (channel is not None and self.getHotCaptureCommand(output) == self._hot_cmd
+                and not channel.closed and not channel.exit_status_ready())
+
+    def _startHotCamera(self, output=None):
+        if self.hotCameraRunning(output):
+            return
+        cmd = self.getHotCaptureCommand(output)
+        if self._hot_channel is not None:
+            self.stopHotCamera()
+        self._hot_channel = self._ssh.get_transport().open_session()
+        self._hot_channel.exec_command('cd ' + self._remote_dir + '; exec ' + cmd)
+        self._hot_cmd = cmd
+        self._hot_to_stdout = output == '-' or (output is None and self._streaming())
+        self._hot_stderr = ''
+        self._hot_stdout = bytearray()
+        self._hot_frames = 0
+        self._hot_prompts = 0
+        if self._logger is not None:
+            self._logger.debug('started hot camera: ' + cmd)
+
+    def stopHotCamera(self):
+        """
+        Stops the long-lived raspistill on remote if it is running
+        """
+        channel = self._hot_channel
+        self._hot_channel = None
+        self._hot_cmd = None
+        if channel is None:
+            return
+        try:
+            if not channel.closed and not channel.exit_status_ready():
+                channel.send('x\n')
+        finally:
+            channel.close()
+
+    def _readHotChannel(self):
+        """
+        Drains pending output from the hot raspistill and returns the number of frames it has finished so far.
+        raspistill reports 'Finished capture <n>' on stderr in verbose mode, but only closes and renames the file after that line.
+        A frame counts as finished once the prompt for the next keypress has followed, which comes after the rename.
+        """
+        channel = self._hot_channel
+        while channel.recv_ready():
+            out = channel.recv(65536)
+            if self._hot_to_stdout:
+                self._hot_stdout += out
+            elif self._logger is not None:
+                self._logger.debug(out.decode(encoding='UTF-8', errors='replace'))
+        while channel.recv_stderr_ready():
+            self._hot_stderr += channel.recv_stderr(4096).decode(encoding='UTF-8', errors='replace')
+        lines = self._hot_stderr.split('\n')
+        self._hot_stderr = lines.pop()
+        for line in lines:
+            if self._logger is not None:
+                self._logger.debug(line)
+            if line.startswith('Finished capture'):
+                self._hot_frames += 1
+            elif line.startswith('Press Enter to capture'):
+                self._hot_prompts += 1
+        # there is a prompt before the first capture too
+        return min(self._hot_frames, max(0, self._hot_prompts - 1))
+
+    def _waitForHotCamera(self):
+        """
+        Waits until the hot raspistill has initialised the camera, i.e. prompts for the first keypress
+        """
+        deadline = time.time() + self.hot_timeout
+        self._readHotChannel()
+        while self._hot_prompts == 0:
+            if self._hot_channel.closed or self._hot_channel.exit_status_ready():
+                self.stopHotCamera()
+                raise Exception('raspistill stopped unexpectedly on Raspberry Pi.')
+            if time.time() > deadline:
+                self.stopHotCamera()
+                raise Exception('Timed out waiting for hot camera to start.')
+            time.sleep(0.005)
+            self._readHotChannel()
+
+    def _triggerHotCamera(self, timings=None):
+        """
+        Triggers a single frame on the hot raspistill and waits until its file has been closed, see _readHotChannel.
+        Returns the frame number, counting from 1 since the process was started.
+
+        :param timings:     CaptureTimings to record the 'exec' (trigger) and 'remote' stages in
+        """
+        frames = self._readHotChannel()
+        t0 = time.perf_counter()
+        self._hot_channel.send('\n')
+        t1 = time.perf_counter()
+        deadline = time.time() + self.hot_timeout
+        while True:
+            ready = self._readHotChannel()
+            if ready != frames:
+                break
+            if self._hot_channel.closed and not self._hot_channel.exit_status_ready():
+                self.stopHotCamera()
+                raise ConnectionError('Lost connection to Raspberry Pi while waiting for hot camera.')
+            if self._hot_channel.exit_status_ready():
+                self._readHotChannel()
+                self.stopHotCamera()
+                raise Exception('raspistill stopped unexpectedly on Raspberry Pi.')
+            if time.time() > deadline:
+                self.stopHotCamera()
+                raise Exception('Timed out waiting for hot camera to capture.')
+            time.sleep(0.005)
+        if timings is not None:
+            timings.add('exec', t1 - t0)
+            timings.add('remote', time.perf_counter() - t1)
+        return ready
+
+    def _popHotFrame(self):
+        """
+        Takes the latest complete JPEG off the stdout buffer of the hot raspistill
+        """
+        deadline = time.time() + self.hot_timeout
+        while True:
+            start = self._hot_stdout.find(b'\xff\xd8')
+            end = findJpegEnd(self._hot_stdout, start) if start >= 0 else -1
+            if end > 0:
+                frame = bytes(self._hot_stdout[start:end])
+                del self._hot_stdout[:end]
+                return frame
+            if time.time() > deadline:
+                raise Exception('Timed out waiting for image data from hot camera.')
+            time.sleep(0.005)
+            self._readHotChannel()
+
+    def _captureBytes(self, cmd, timings=None):
+        """
+        Runs a capture command writing the image to stdout and returns the image read off the channel.
+        stdout and stderr are drained together so the verbose output can not stall the transfer.
+        If the connection is lost, it is reopened and the image captured again from scratch.
+
+        :param timings:     CaptureTimings to record the stages in. 
+                            'remote' lasts until the first image byte arrives and 'transfer' from there until the end of the stream.
+        """
+        return self._withReconnect(self._captureBytesOnce, cmd, timings)
+
+    def _captureBytesOnce(self, cmd, timings=None):
+        """
+        Runs a capture command once, see _captureBytes
+        """
+        data = []
+        first = []
+
+        def on_stdout(chunk):
+            if not first:
+                first.append(time.perf_counter())
+            data.append(chunk)
+        t0 = time.perf_counter()
+        res = self._executeOnce(cmd, on_stdout=on_stdout)
+        if timings is not None:
+            done = t0 + res.exec_time + res.runtime
+            first = first[0] if first else done
+            timings.add('exec', res.exec_time)
+            timings.add('remote', first - t0 - res.exec_time)
+            timings.add('transfer', done - first)
+            timings.bytes = sum(len(d) for d in data)
+        return b''.join(data)
+
+    def getCapturedImage(self):
+        """
+        Returns the last captured image as something PIL.Image.open accepts, i.e. a path or an in-memory stream
+        """
+        if self._img_bytes is not None:
+            return io.BytesIO(self._img_bytes)
+        return self._local_img
+
+    def getPreviewCommand(self, width, height, fps):
+        """
+        Generates the command for streaming a reduced resolution MJPEG preview with the currently set options to stdout.
+        The bitrate is scaled with the preview size, so bandwidth follows the size of the window rather than of the sensor.
+        """
+        s = " "
+        bitrate = int(width * height * fps * self.preview_bits_per_pixel)
+        res = "raspivid -cd MJPEG -n -t 0 -o - -w %d -h %d -fps %d -b %d" % (width, height, fps, bitrate)
+        for option in self._options:
+            # raw capture only applies to stills
+            if not isinstance(option, op.FlagOption):
+                res += s + option.getArguments()
+        return res
+
+    def startPreview(self, width, height, fps=15):
+        """
+        Starts a live preview on remote. The hot camera is stopped first, as only one process can own the camera.
+        Stop the returned PreviewStream before capturing stills.
+        """
+        self.stopHotCamera()
+        return PreviewStream(self._ssh.get_transport(), self._remote_dir, self.getPreviewCommand(width, height, fps), self._logger)
+
     def setOption(self, name, value):
         """
         Sets a named option to a given value
@@ -165,20 +1015,763 @@ class RaspiStillCommClass(BaseCommClass):
         """
         self._options = value
 
-    def capture(self):
+    def capture(self, sync=None, progress=None):
         """
         Capture image.
         Immediately transfers captured image to host machine and deletes it on remote.
+        In streaming mode the image is kept in memory instead, see getCapturedImage.
+        The previous capture is deleted on the host, unless an archive is set, see setArchive.
+        If the connection is lost, it is reopened and the capture taken again, unless sync is given.
+
+        A lost connection during the transfer is reopened and the transfer resumed, see _get.
+
+        :param sync:        optional threading.Barrier waited on right before the camera is triggered,
+                            used for triggering several cameras at once
+        :param progress:    called with (bytes received, total bytes) while the image is transferred from a file on remote
+        """
+        self._idle.clear()
+        try:
+            if sync is not None:
+                # the other cameras have been released already, so retrying would only break the barrier
+                remote_pth = self._capture(sync)
+            else:
+                remote_pth = self._withReconnect(self._capture)
+            if remote_pth is not None:
+                self._get(remote_pth, self._local_img, self.last_timings, progress)
+                if remote_pth != self._remote_img:
+                    self._execute('rm -f ' + remote_pth)
+            if self._adaptive is not None and self._plan is not None:
+                self._adaptive.record(self.last_timings, self._plan)
+            if self._archive is not None and self._roi is None and self._original_img is None:
+                # a thumbnail-first capture is archived once its original has arrived
+                with self.last_timings.stage('archive'):
+                    self.last_frame = self._archive.add(self._img_bytes if self._img_bytes is not None else self._local_img, **self._captureInfo())
+        finally:
+            self._idle.set()
+
+    def _capture(self, sync=None):
+        """
+        Takes a capture, see capture. Returns the file on remote still to be transferred to _local_img, if any.
         """
         if self._local_img is not None:
-            os.remove(self._local_img)
+            # a capture which failed before its transfer leaves no local image behind, and only archived captures are kept
+            if self.last_frame is None and os.path.isfile(self._local_img):
+                os.remove(self._local_img)
+            self._local_img = None
+        self._img_bytes = None
+        self._original_img = None
+        self.last_frame = None
+        self._plan = self._adaptive.plan() if self._adaptive is not None and self._roi is None else None
+        output = self._adaptiveOutput() if self._thumbnailFirst() else None
+        timings = CaptureTimings(('hot ' if self._hot else '') + ('stream' if self._streaming() else 'file')
+                                 + (' raw' if self.rawEnabled() else '') + (' roi' if self._roi else ''))
+        if self._plan is not None:
+            timings.mode += ' ' + str(self._plan)
+        self.last_timings = timings
+
+        if self._hot:
+            if not self.hotCameraRunning(output):
+                # timed apart from 'remote', as it is not part of every capture
+                with timings.stage('start'):
+                    self.startHotCamera(output)
+                    self._waitForHotCamera()
+            self._last_command = self._hot_cmd
+        if sync is not None:
+            sync.wait()
+
+        if self._thumbnailFirst():
+            return self._captureThumbnailFirst(output, timings)
+
+        if self._streaming():
+            if self._hot:
+                self._triggerHotCamera(timings)
+                with timings.stage('transfer'):
+                    self._img_bytes = self._popHotFrame()
+                timings.bytes = len(self._img_bytes)
+            else:
+                with timings.stage('command'):
+                    cmd = self.getCaptureCommand()
+                self._last_command = cmd
+                self._img_bytes = self._captureBytes(cmd, timings)
+            return
+
+        self._local_img = self._localName()
+        if self._hot:
+            self._triggerHotCamera(timings)
+        else:
+            with timings.stage('command'):
+                cmd = self.getCaptureCommand()
+            self._last_command = cmd
+            self._runCommand(cmd, timings=timings)
+        return self._remote_img
+
+    def _localName(self):
+        if self._archive is not None and self._roi is None:
+            local_dir = self._archive.directory
+        else:
+            local_dir = self.local_dir if self.local_dir is not None else os.getcwd()
+        return os.path.join(local_dir, "img_" + str(datetime.now()).replace(" ", "_").replace(":", "-") + ".jpeg")
+
+    def _adaptiveOutput(self):
+        """
+        Output on remote of a thumbnail-first capture. Every original gets a file of its own, as it stays on remote until fetched.
+        A hot camera numbers the files itself, so a pattern is returned.
+        """
+        if self._hot:
+            pattern = 'adaptive_%s_%%04d.jpeg' % self._adaptive_prefix
+            if self._adaptive_prefix is None or not self.hotCameraRunning(pattern):
+                # a newly started process numbers from 1 again, while originals of the previous one may still be waiting
+                self._adaptive_prefix = str(datetime.now()).replace(" ", "_").replace(":", "-")
+                pattern = 'adaptive_%s_%%04d.jpeg' % self._adaptive_prefix
+            return pattern
+        if self._adaptive_prefix is None:
+            self._adaptive_prefix = str(datetime.now()).replace(" ", "_").replace(":", "-")
+        self._adaptive_count += 1
+        return 'adaptive_%s_%04d.jpeg' % (self._adaptive_prefix, self._adaptive_count)
+
+    def _captureThumbnailFirst(self, output, timings):
+        """
+        Captures into output on remote and keeps the EXIF thumbnail as the captured image.
+        The original is queued for the background fetcher, or returned for transferring right away if it has no thumbnail.
+        """
+        if self._hot:
+            remote_pth = output % self._triggerHotCamera(timings)
+        else:
+            remote_pth = output
+            with timings.stage('command'):
+                cmd = self.getCaptureCommand(output)
+            self._last_command = cmd
+            self._runCommand(cmd, timings=timings)
+        from Adaptive import exifThumbnail, exifLength
+        with timings.stage('transfer'):
+            with self._sftp.open(remote_pth, 'rb') as f:
+                head = f.read(6)
+                head += f.read(max(0, exifLength(head) - len(head)))
+            thumbnail = exifThumbnail(head)
+        timings.bytes = len(head)
+        self._local_img = self._localName()
+        if thumbnail is None:
+            if self._logger is not None:
+                self._logger.warning('no thumbnail in ' + remote_pth + ', transferring the original')
+            return remote_pth
+        self._img_bytes = thumbnail
+        self._original_img = self._local_img
+        self._local_img = None
+        self._queueOriginal(remote_pth, self._original_img, self._captureInfo() if self._archive is not None else None)
+        return None
+
+    def _queueOriginal(self, remote_pth, local_pth, info=None):
+        with self._fetch_lock:
+            self._originals.put((remote_pth, local_pth, info))
+            if self._fetcher is None or not self._fetcher.is_alive():
+                self._fetcher = threading.Thread(target=self._fetchOriginals, daemon=True)
+                self._fetcher.start()
+
+    def _fetchOriginals(self):
+        """
+        Fetches the originals of thumbnail-first captures one at a time, only starting while no capture is running.
+        Originals which could not be fetched are left on remote and listed in failed_originals.
+        Originals of captures taken with an archive set are added to it.
+        """
+        while True:
+            with self._fetch_lock:
+                try:
+                    remote_pth, local_pth, info = self._originals.get_nowait()
+                except queue.Empty:
+                    return
+            self._idle.wait()
+            timings = CaptureTimings('original')
+            try:
+                self._get(remote_pth, local_pth, timings, own_session=True)
+                self._execute('rm -f ' + remote_pth)
+            except Exception as e:
+                self.failed_originals.append((remote_pth, str(e)))
+                if self._logger is not None:
+                    self._logger.critical('could not fetch original ' + remote_pth + ': ' + str(e))
+                continue
+            if self._adaptive is not None:
+                self._adaptive.record(timings)
+                self._adaptive.recordSize(timings.bytes)
+            if info is not None and self._archive is not None:
+                self._archive.add(local_pth, **info)
+            if self.on_original is not None:
+                self.on_original(local_pth)
+
+    def waitForOriginals(self, timeout=None):
+        """
+        Waits until all queued originals have been fetched. Returns False on timeout.
+        """
+        fetcher = self._fetcher
+        if fetcher is not None:
+            fetcher.join(timeout)
+            return not fetcher.is_alive()
+        return True
+
+    def burst(self, n, interval=0, local_dir=None, max_in_flight=4, on_frame=None):
+        """
+        Captures a burst or time-lapse of n frames.
+        Frames are numbered on remote and pulled by a transfer thread while the next frame is being captured.
+        At most max_in_flight frames wait for transfer; beyond that capturing is held back.
+        If capturing falls behind the interval by whole slots, those slots are dropped to keep the time-lapse on schedule.
+        With an archive set (see setArchive), every frame is moved into it as it arrives.
+
+        :param n:               number of frames
+        :param interval:        seconds between frames, 0 captures as fast as possible
+        :param local_dir:       directory on local machine for the frames, defaults to the current working directory
+        :param max_in_flight:   maximum number of captured frames waiting for transfer
+        :param on_frame:        called from the transfer thread with (frame number, local path) for every transferred frame
+        """
+        local_dir = local_dir if local_dir is not None else os.getcwd()
+        stamp = str(datetime.now()).replace(" ", "_").replace(":", "-")
+        remote_pattern = 'burst_%04d.jpeg'
+        report = BurstReport(n, interval)
+        pending = queue.Queue(maxsize=max_in_flight)
+        self._plan = None
+
+        def transfer():
+            sftp = self._ssh.open_sftp()
+            sftp.chdir(self._remote_dir)
+            try:
+                while True:
+                    item = pending.get()
+                    if item is None:
+                        return
+                    frame, captured = item
+                    remote_pth = remote_pattern % frame
+                    local_pth = os.path.join(local_dir, 'burst_' + stamp + '_%04d.jpeg' % frame)
+                    try:
+                        sftp.get(remote_pth, local_pth)
+                        sftp.remove(remote_pth)
+                    except (IOError, OSError) as e:
+                        report.failed.append((frame, str(e)))
+                        continue
+                    local_pth = self._archiveFrame(local_pth, command, 'burst', captured=captured)
+                    report.addFrame(local_pth, time.time() - captured)
+                    if on_frame is not None:
+                        on_frame(frame, local_pth)
+            finally:
+                sftp.close()
+
+        self.stopHotCamera()
+        self.startHotCamera(remote_pattern)
+        command = self._hot_cmd
+        transfer_thread = threading.Thread(target=transfer, daemon=True)
+        transfer_thread.start()
+        try:
+            # the schedule starts once the camera is up, so its start-up does not count as dropped slots
+            self._waitForHotCamera()
+        except Exception:
+            pending.put(None)
+            transfer_thread.join()
+            raise
+        report.start()
+        try:
+            slot = 0
+            while slot < n:
+                if interval > 0:
+                    delay = report.started + slot * interval - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif -delay >= interval:
+                        skipped = min(int(-delay / interval), n - slot)
+                        report.dropped += skipped
+                        slot += skipped
+                        continue
+                frame = self._triggerHotCamera()
+                pending.put((frame, time.time()))
+                slot += 1
+        finally:
+            pending.put(None)
+            self.stopHotCamera()
+            transfer_thread.join()
+            report.stop()
+        if self._logger is not None:
+            self._logger.debug(str(report))
+        return report
+
+    def sweepGrid(self, grid):
+        """
+        Expands a grid of option values into all combinations, e.g. {'ISO': [100, 400], 'EV': [-2, 0, 2]} into 6 overrides for sweep.
+        None as the values of a GenericOption stands for all its values. Values are checked against the bounds and value lists of the options.
+        """
+        options = {option.name: option for option in self._options}
+        names = list(grid)
+        values = []
+        for name in names:
+            if name not in options:
+                raise Exception('Unknown option ' + name)
+            option = options[name]
+            vals = grid[name]
+            if vals is None:
+                if not isinstance(option, op.GenericOption):
+                    raise Exception('Values to sweep must be given for ' + name)
+                vals = option.potential_values
+            invalid = [str(v) for v in vals if not option.accepts(v)]
+            if invalid:
+                raise Exception('Invalid values for %s: %s' % (name, ', '.join(invalid)))
+            values.append(list(vals))
+        return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+    def sweep(self, overrides, local_dir=None, on_frame=None):
+        """
+        Captures one frame for each dict of option values in overrides, applied on top of the current options (see sweepGrid).
+        All captures run back to back from a single script on remote, and each frame is transferred while the next ones are captured.
+        The current options are left as they are. Frames are named after their settings, which are also listed in a JSON file next to them.
+        With an archive set (see setArchive), every frame is moved into it as it arrives.
+
+        :param overrides:   list of {option name: value}
+        :param local_dir:   directory on local machine for the frames, defaults to the current working directory
+        :param on_frame:    called from the transfer thread with the SweepFrame of every transferred frame
+        :return:            SweepReport
+        """
+        local_dir = local_dir if local_dir is not None else os.getcwd()
+        stamp = str(datetime.now()).replace(" ", "_").replace(":", "-")
+        remote_pattern = 'sweep_' + stamp + '_%03d.jpeg'
+        options = {option.name: option for option in self._options}
+        saved = {option.name: option.value for option in self._options}
+        self._plan = None
+        frames = []
+        try:
+            for index, settings in enumerate(overrides):
+                for name, value in settings.items():
+                    options[name].value = value
+                frames.append(SweepFrame(index, settings, self.getCaptureCommand(remote_pattern % index)))
+        finally:
+            for name, value in saved.items():
+                options[name].value = value
+        # the marker on stderr tells which frame is done, so it can be transferred while the next one is captured
+        script = '\n'.join('%s; echo "SWEEP %d $?" >&2' % (frame.command, frame.index) for frame in frames) + '\n'
+        report = SweepReport(frames)
+        pending = queue.Queue()
+        done = set()
+
+        def on_stderr(line):
+            match = re.match(r'SWEEP (\d+) (\d+)$', line.strip())
+            if match is None:
+                return
+            index, status = int(match.group(1)), int(match.group(2))
+            if index in done:
+                return
+            done.add(index)
+            if status != 0:
+                frames[index].error = 'raspistill exited with status %d' % status
+                return
+            pending.put(frames[index])
+
+        def transfer():
+            while True:
+                frame = pending.get()
+                if frame is None:
+                    return
+                tag = '_'.join('%s%s' % (name, value) for name, value in frame.settings.items())
+                local_pth = os.path.join(local_dir, 'sweep_%s_%03d_%s.jpeg' % (stamp, frame.index, re.sub(r'[^\w.+-]', '', tag)))
+                try:
+                    self._get(remote_pattern % frame.index, local_pth, own_session=True)
+                except Exception as e:
+                    frame.error = str(e)
+                    continue
+                frame.path = self._archiveFrame(local_pth, frame.command, 'sweep', frame.settings)
+                if on_frame is not None:
+                    on_frame(frame)
+
+        self.stopHotCamera()
+        transfer_thread = threading.Thread(target=transfer, daemon=True)
+        transfer_thread.start()
+        report.start()
+        try:
+            self._execute('sh -s', stdin=script.encode(), timeout=self.command_timeout * max(1, len(frames)), on_stderr=on_stderr, check=False)
+        finally:
+            pending.put(None)
+            transfer_thread.join()
+            report.stop()
+            self._execute('rm -f sweep_' + stamp + '_*.jpeg', check=False)
+        for frame in frames:
+            if frame.path is None and frame.error is None:
+                frame.error = 'not captured'
+        report.save(os.path.join(local_dir, 'sweep_' + stamp + '.json'))
+        if self._logger is not None:
+            self._logger.debug(str(report))
+        return report
+
+    def watch(self, threshold=12, fraction=0.01, cooldown=5, block=16, size=(320, 240), fps=5, settle=3,
+              local_dir=None, max_captures=None, stop=None, on_capture=None, fake=None):
+        """
+        Unattended monitoring: captures and transfers a full resolution still only when the scene changes.
+        MotionHelper.py is copied to remote and compares low resolution frames there, so while the scene is still
+        nothing but the helper's lines crosses the link. On a change the helper releases the camera, the still is captured
+        with the current options as by capture, and the helper resumes watching.
+        Adaptive mode is off while watching, as there is nobody waiting for a thumbnail, and so is the hot camera,
+        as the helper needs the camera back after every capture.
+        If the connection is lost, it is reopened and the helper started again, at most settings.retries times in a row.
+
+        :param threshold:       mean difference of a block, 0-255, for it to count as changed
+        :param fraction:        fraction of changed blocks which counts as a change of the scene
+        :param cooldown:        seconds after a capture during which changes are ignored
+        :param block:           size of the compared blocks in pixels
+        :param size:            (width, height) of the compared frames
+        :param fps:             frames compared per second
+        :param settle:          frames skipped after the camera is started, while exposure settles
+        :param local_dir:       directory on local machine for the captures, defaults to the current working directory.
+                                Not used with an archive, which gets the captures instead, see setArchive.
+        :param max_captures:    stop after this many captures, None to watch until stopped
+        :param stop:            threading.Event which ends the watch when set
+        :param on_capture:      called with the WatchEvent of every capture
+        :param fake:            frame script for the fake source of MotionHelper.py instead of the camera, for testing
+        :return:                WatchReport
+        """
+        local_dir = local_dir if local_dir is not None else os.getcwd()
+        stamp = str(datetime.now()).replace(" ", "_").replace(":", "-")
+        self.stopHotCamera()
+        self._put('motion_helper.py', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MotionHelper.py'))
+        cmd = ('python3 motion_helper.py --width %d --height %d --fps %g --block %d --threshold %g --fraction %g --cooldown %g --settle %d'
+               % (size[0], size[1], fps, block, threshold, fraction, cooldown, settle))
+        if fake is not None:
+            cmd += ' --fake ' + fake
+
+        def startHelper():
+            channel = self._ssh.get_transport().open_session()
+            channel.exec_command('cd ' + self._remote_dir + '; ' + cmd)
+            # short, so stop is noticed while the scene is still
+            channel.settimeout(0.5)
+            return channel
+
+        channel = startHelper()
+        report = WatchReport()
+        adaptive, self._adaptive = self._adaptive, None
+        # a hot raspistill would keep the camera from the helper
+        hot, self._hot = self._hot, False
+        buf = b''
+        restarts = 0
+        report.start()
+        try:
+            while stop is None or not stop.is_set():
+                nl = buf.find(b'\n')
+                if nl < 0:
+                    try:
+                        data = channel.recv(4096)
+                    except socket.timeout:
+                        continue
+                    if data:
+                        buf += data
+                        restarts = 0
+                        continue
+                    if report.compared is not None or channel.get_transport().is_active():
+                        break
+                    # the channel went with the connection, which has to be reopened
+                    channel.close()
+                    restarts += 1
+                    if restarts > self.settings.retries:
+                        raise ConnectionError('Lost the connection to %s while watching' % self._ip)
+                    if self._logger is not None:
+                        self._logger.warning('lost connection to %s while watching, starting the motion helper again' % self._ip)
+                    with self._reconnect_lock:
+                        self.reconnect()
+                    channel = startHelper()
+                    buf = b''
+                    continue
+                fields = buf[:nl].decode(encoding='UTF-8', errors='replace').split()
+                buf = buf[nl + 1:]
+                if not fields or fields[0] != 'MOTION':
+                    if fields and fields[0] == 'END':
+                        report.compared = int(fields[1])
+                    continue
+                event = WatchEvent(int(fields[1]), float(fields[2]), float(fields[3]))
+                try:
+                    self.capture()
+                    event.path = self._keepWatchCapture(local_dir, 'motion_%s_%04d.jpeg' % (stamp, len(report.events)))
+                    event.bytes = self.last_timings.bytes or 0
+                except Exception as e:
+                    event.error = str(e)
+                    if self._logger is not None:
+                        self._logger.critical('capture after a change failed: ' + str(e))
+                report.events.append(event)
+                if on_capture is not None:
+                    on_capture(event)
+                if max_captures is not None and len(report.events) >= max_captures:
+                    break
+                try:
+                    channel.send('resume\n')
+                except (OSError, EOFError):
+                    # the connection was lost during the capture, noticed by the next recv
+                    pass
+        finally:
+            self._adaptive = adaptive
+            self._hot = hot
+            report.stop()
+            # closing stdin stops the helper, which releases the camera
+            status, stderr = 0, ''
+            try:
+                if not channel.closed:
+                    channel.shutdown_write()
+                    deadline = time.time() + 5
+                    while not channel.exit_status_ready() and time.time() < deadline:
+                        time.sleep(0.01)
+                    status = channel.recv_exit_status() if channel.exit_status_ready() else 0
+                    stderr = channel.recv_stderr(65536).decode(encoding='UTF-8', errors='replace') if channel.recv_stderr_ready() else ''
+            except (OSError, EOFError):
+                pass
+            finally:
+                channel.close()
+        if status not in (0, -1):
+            if not report.events:
+                raise Exception('Motion helper failed on remote: ' + stderr.strip())
+            if self._logger is not None:
+                self._logger.critical('motion helper failed on remote: ' + stderr.strip())
+        if self._logger is not None:
+            self._logger.debug(str(report))
+        return report
+
+    def _keepWatchCapture(self, local_dir, name):
+        """
+        Keeps the last capture from being deleted by the next one. Returns its path.
+        """
+        if self._archive is not None and self.last_frame is not None:
+            return self._archive.path(self.last_frame)
+        local_pth = os.path.join(local_dir, name)
+        if self._img_bytes is not None:
+            with open(local_pth, 'wb') as f:
+                f.write(self._img_bytes)
+        else:
+            os.replace(self._local_img, local_pth)
             self._local_img = None
+        return local_pth
+
+
+class WatchEvent:
+    """
+    A change of the scene seen by RaspiStillCommClass.watch and the capture it triggered
+    """
+    def __init__(self, frame, changed, level):
+        """
+        :param frame:   number of the compared frame on remote
+        :param changed: fraction of blocks which changed
+        :param level:   mean difference in the changed blocks, 0-255
+        """
+        self.time = datetime.now()
+        self.frame = frame
+        self.changed = changed
+        self.level = level
+        self.path = None
+        self.bytes = 0
+        self.error = None
+
+    def __str__(self):
+        return '%s %.1f %% changed by %.0f: %s' % (self.time.strftime('%H:%M:%S'), 100 * self.changed, self.level,
+                                                     self.path if self.error is None else 'failed, ' + self.error)
+
+
+class WatchReport:
+    """
+    Statistics of a watch run
+    """
+    def __init__(self):
+        self.events = []
+        self.compared = None
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        self.started = time.time()
 
-        im_name = "img_" + str(datetime.now()).replace(" ", "_").replace(":", "-") + ".jpeg"
-        self._local_img = os.path.join(os.getcwd(), im_name)
-        cmd = self.getCaptureCommand()
-        self._runCommand(cmd)
-        self._get(self._remote_img, self._local_img)
+    def stop(self):
+        self.elapsed = time.time() - self.started
+
+    def captured(self):
+        return [event for event in self.events if event.error is None]
+
+    def __str__(self):
+        captured = self.captured()
+        return ('%d captures in %.1f s (%.1f per hour), %d kB transferred, %d failed'
+                % (len(captured), self.elapsed or 0.0, 3600 * len(captured) / self.elapsed if self.elapsed else 0.0,
+                   sum(event.bytes for event in captured) / 1000, len(self.events) - len(captured)))
+
+
+class PreviewStream:
+    """
+    A live MJPEG stream from a remote process over a single ssh channel.
+    A reader thread cuts the stream into JPEG frames and only keeps the latest one, so a slow consumer never falls behind.
+    """
+    def __init__(self, transport, remote_dir, cmd, logger=None):
+        """
+        :param transport:   paramiko transport of an open ssh connection
+        :param remote_dir:  directory on remote to run cmd from
+        :param cmd:         command writing a stream of JPEG images to stdout
+        """
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._frame = None
+        self._count = 0
+        self._bytes = 0
+        self._started = time.time()
+        self._channel = transport.open_session()
+        # the shell stays in the foreground to stop the stream when a line arrives on stdin, 
+        # so the camera is released before stop() returns
+        self._channel.exec_command('cd ' + remote_dir + '; ' + cmd + ' & p=$!; read x; kill $p; wait $p')
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        buf = bytearray()
+        while True:
+            data = self._channel.recv(65536)
+            if not data:
+                break
+            buf += data
+            self._bytes += len(data)
+            while True:
+                start = buf.find(b'\xff\xd8')
+                if start < 0:
+                    buf.clear()
+                    break
+                try:
+                    end = findJpegEnd(buf, start)
+                except ValueError:
+                    # resynchronise on the next start of image
+                    del buf[:start + 2]
+                    continue
+                if end < 0:
+                    del buf[:start]
+                    break
+                with self._lock:
+                    self._frame = bytes(buf[start:end])
+                    self._count += 1
+                del buf[:end]
+        if self._logger is not None and self._channel.recv_stderr_ready():
+            self._logger.critical(self._channel.recv_stderr(65536).decode(encoding='UTF-8', errors='replace'))
+
+    def latestFrame(self):
+        """
+        Returns (frame number, JPEG bytes) of the newest complete frame, or (0, None) before the first frame has arrived
+        """
+        with self._lock:
+            return self._count, self._frame
+
+    def running(self):
+        return self._thread.is_alive()
+
+    def fps(self):
+        """
+        Average frame rate since the stream was started
+        """
+        return self._count / max(time.time() - self._started, 1e-6)
+
+    def bandwidth(self):
+        """
+        Average bytes per second since the stream was started
+        """
+        return self._bytes / max(time.time() - self._started, 1e-6)
+
+    def stop(self, timeout=5):
+        """
+        Stops the stream and waits for the remote process to release the camera
+        """
+        try:
+            if not self._channel.exit_status_ready():
+                self._channel.send('\n')
+            deadline = time.time() + timeout
+            while not self._channel.exit_status_ready() and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            self._channel.close()
+            self._thread.join(timeout)
+
+
+class BurstReport:
+    """
+    Statistics of a burst/time-lapse run
+    """
+    def __init__(self, requested, interval):
+        self.requested = requested
+        self.interval = interval
+        self.frames = []
+        self.lags = []
+        self.failed = []
+        self.dropped = 0
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        self.started = time.time()
+
+    def stop(self):
+        self.elapsed = time.time() - self.started
+
+    def addFrame(self, local_pth, lag):
+        self.frames.append(local_pth)
+        self.lags.append(lag)
+
+    def fps(self):
+        """
+        Achieved frames per second, counting transferred frames only
+        """
+        return len(self.frames) / self.elapsed if self.elapsed else 0.0
+
+    def framesPerMinute(self):
+        return 60 * self.fps()
+
+    def meanLag(self):
+        """
+        Mean time in seconds from a frame was captured until it was on the local machine
+        """
+        return sum(self.lags) / len(self.lags) if self.lags else 0.0
+
+    def __str__(self):
+        return ('%d/%d frames in %.1f s (%.1f frames/min), transfer lag mean %.2f s max %.2f s, %d dropped, %d failed'
+                % (len(self.frames), self.requested, self.elapsed or 0.0, self.framesPerMinute(), self.meanLag(),
+                   max(self.lags) if self.lags else 0.0, self.dropped, len(self.failed)))
+
+
+class SweepFrame:
+    """
+    One frame of a sweep, tagged with the option values it was captured with
+    """
+    def __init__(self, index, settings, command):
+        self.index = index
+        self.settings = settings
+        self.command = command
+        self.path = None
+        self.error = None
+
+    def label(self):
+        return ' '.join('%s %s' % (name, value) for name, value in self.settings.items())
+
+    def toDict(self):
+        return {'index': self.index, 'settings': {name: str(value) for name, value in self.settings.items()},
+                'command': self.command, 'path': self.path, 'error': self.error}
+
+
+class SweepReport:
+    """
+    Frames and timing of a sweep run
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        self.started = time.time()
+
+    def stop(self):
+        self.elapsed = time.time() - self.started
+
+    def captured(self):
+        return [frame for frame in self.frames if frame.path is not None]
+
+    def failed(self):
+        return [frame for frame in self.frames if frame.error is not None]
+
+    def save(self, path):
+        """
+        Writes the settings, command and local path of every frame as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump({'started': self.started, 'elapsed': self.elapsed, 'frames': [frame.toDict() for frame in self.frames]}, f, indent=1)
+
+    def __str__(self):
+        n = len(self.captured())
+        return ('%d/%d frames in %.1f s (%.2f s per frame), %d failed'
+                % (n, len(self.frames), self.elapsed or 0.0, (self.elapsed or 0.0) / max(1, n), len(self.failed())))
 
 
 if __name__ == '__main__':
@@ -189,10 +1782,29 @@ if __name__ == '__main__':
     parser.add_argument('pswd', help='Password for RPi')
     parser.add_argument('user', help='Username for RPi')
     parser.add_argument('remote_dir', help='Workspace for this program')
+    parser.add_argument('--hot', action='store_true', help='Keep raspistill running between captures')
+    parser.add_argument('--stream', action='store_true', help='Pipe images over ssh instead of writing them to disk')
+    parser.add_argument('--keepalive', type=int, default=10, help='Seconds between keepalive packets, 0 to disable')
+    parser.add_argument('--compress', action='store_true', help='Compress the ssh transport, helps on a slow link')
+    parser.add_argument('--cipher', action='append', default=None, help='Allowed ssh cipher, e.g. aes128-ctr. Can be given several times')
+    parser.add_argument('--window', type=int, default=None, help='ssh window size in bytes')
+    parser.add_argument('--raw', action='store_true', help='Add the raw Bayer data to captured images')
+    parser.add_argument('--verify', action='store_true', help='Check the sha256 of every transferred image')
+    parser.add_argument('--watch', action='store_true', help='Capture only when the scene changes, until interrupted')
+    parser.add_argument('--threshold', type=float, default=12, help='Mean difference of a block, 0-255, for --watch to count it as changed')
+    parser.add_argument('--cooldown', type=float, default=5, help='Seconds after a --watch capture during which changes are ignored')
+    parser.add_argument('--fake', default=None, help='Frame script for --watch to use instead of the camera, e.g. still:20,move:5')
     args = parser.parse_args()    
-    c = RaspiStillCommClass(args.ip, args.user, args.pswd, args.remote_dir, log=True)
+    c = RaspiStillCommClass(args.ip, args.user, args.pswd, args.remote_dir, log=True, hot=args.hot, stream=args.stream,
+                             settings=SshSettings(keepalive=args.keepalive, compress=args.compress, ciphers=args.cipher, window_size=args.window))
+    if args.raw:
+        c.setOption('raw', 'on')
+    c.verify_transfers = args.verify
     try:
-        c.capture()
+        if args.watch:
+            c.watch(threshold=args.threshold, cooldown=args.cooldown, fake=args.fake, on_capture=print)
+        else:
+            c.capture()
         del c
     except:
         del c
\ No newline at end of file
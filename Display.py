@@ -0,0 +1,210 @@
+import io
+import math
+import time
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+class CapturedImage:
+    """
+    Class holding a captured JPEG as its original bytes together with cached renditions scaled for display.
+    Renditions are decoded at a reduced DCT scale (PIL draft mode) when only a screen sized view is needed,
+    and the original bytes are saved as they are, without decoding and recompressing.
+    """
+    def __init__(self, data, max_renditions=4):
+        """
+        :param data:            JPEG bytes
+        :param max_renditions:  number of scaled renditions kept in memory
+        """
+        self.data = data
+        self._max_renditions = max_renditions
+        self._renditions = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = None
+
+    @classmethod
+    def fromSource(cls, source):
+        """
+        Creates a CapturedImage from bytes, a path or a binary stream, e.g. RaspiStillCommClass.getCapturedImage()
+        """
+        if isinstance(source, (bytes, bytearray)):
+            return cls(bytes(source))
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                return cls(f.read())
+        return cls(source.read())
+
+    def size(self):
+        """
+        Size of the original image. Only the JPEG header is parsed.
+        """
+        if self._size is None:
+            self._size = Image.open(io.BytesIO(self.data)).size
+        return self._size
+
+    def fitSize(self, box):
+        """
+        Largest size with the aspect ratio of the image fitting inside box
+        """
+        w, h = self.size()
+        factor = min(box[0] / w, box[1] / h)
+        return max(1, int(factor * w)), max(1, int(factor * h))
+
+    def rendition(self, box, timings=None):
+        """
+        Returns the image scaled to fit inside box as a PIL image. Renditions are cached per size.
+
+        :param timings:     CaptureTimings to record the 'decode' and 'resize' stages in
+        """
+        size = self.fitSize(box)
+        with self._lock:
+            if size in self._renditions:
+                self._renditions.move_to_end(size)
+                return self._renditions[size]
+        t0 = time.perf_counter()
+        img = Image.open(io.BytesIO(self.data))
+        # let libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the requested size
+        img.draft('RGB', size)
+        img.load()
+        t1 = time.perf_counter()
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+        if timings is not None:
+            timings.add('decode', t1 - t0)
+            timings.add('resize', time.perf_counter() - t1)
+        with self._lock:
+            self._renditions[size] = img
+            while len(self._renditions) > self._max_renditions:
+                self._renditions.popitem(last=False)
+        return img
+
+    def decode(self):
+        """
+        Returns the image decoded at full resolution
+        """
+        img = Image.open(io.BytesIO(self.data))
+        img.load()
+        return img
+
+    def save(self, path):
+        """
+        Saves the original bytes
+        """
+        with open(path, 'wb') as f:
+            f.write(self.data)
+
+
+class TilePyramid:
+    """
+    Class cutting a CapturedImage into tiles at several resolutions for zooming into it.
+    Level k holds the image at 1/2**k scale, for k from 0 (full resolution) to LEVELS - 1.
+    Levels are decoded on first use, at reduced DCT scale for k >= 1, and only the max_levels most recently used are kept,
+    so memory follows the zoom being viewed instead of holding every resolution. Tiles are cropped from a level on request.
+    """
+    TILE = 256
+    LEVELS = 4
+
+    def __init__(self, image, max_levels=2):
+        """
+        :param image:       CapturedImage
+        :param max_levels:  number of decoded levels kept in memory
+        """
+        self.image = image
+        self._max_levels = max_levels
+        self._levels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def levelSize(self, level):
+        w, h = self.image.size()
+        return -(-w // 2**level), -(-h // 2**level)
+
+    def tileCount(self, level):
+        """
+        Number of tiles (columns, rows) of a level
+        """
+        w, h = self.levelSize(level)
+        return -(-w // self.TILE), -(-h // self.TILE)
+
+    def loaded(self, level):
+        with self._lock:
+            return level in self._levels
+
+    def load(self, level):
+        """
+        Decodes a level if it is not in memory yet. Can take a few hundred milliseconds for level 0, so call it off the UI thread.
+        """
+        with self._lock:
+            if level in self._levels:
+                self._levels.move_to_end(level)
+                return
+        size = self.levelSize(level)
+        img = Image.open(io.BytesIO(self.image.data))
+        if level > 0:
+            img.draft('RGB', size)
+        img.load()
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if img.size != size:
+            img = img.resize(size, Image.BILINEAR)
+        with self._lock:
+            self._levels[level] = img
+            while len(self._levels) > self._max_levels:
+                self._levels.popitem(last=False)
+
+    def level(self, level):
+        """
+        Returns a decoded level as a PIL image and marks it as recently used, or None if it is not loaded.
+        The image stays valid when the level is evicted meanwhile, so tiles of one view should be cut from it, see cropTile.
+        """
+        with self._lock:
+            img = self._levels.get(level)
+            if img is not None:
+                self._levels.move_to_end(level)
+            return img
+
+    def cropTile(self, img, column, row):
+        """
+        Returns a tile of a level image, smaller than TILE at the right and bottom edges
+        """
+        x, y = column * self.TILE, row * self.TILE
+        return img.crop((x, y, min(x + self.TILE, img.size[0]), min(y + self.TILE, img.size[1])))
+
+    def tile(self, level, column, row):
+        """
+        Returns a tile of a level as a PIL image, smaller than TILE at the right and bottom edges, or None if the level is not loaded
+        """
+        img = self.level(level)
+        return self.cropTile(img, column, row) if img is not None else None
+
+
+def contactSheet(images, labels, tile=(320, 240), columns=None, background=(24, 24, 24)):
+    """
+    Renders images side by side in a grid, each with its label underneath, for comparing the frames of a sweep.
+    The tiles are decoded at reduced scale, see CapturedImage.rendition.
+
+    :param images:  list of CapturedImage, None for a frame which failed
+    :param labels:  text under each image
+    :param tile:    size every image is fitted into
+    :param columns: number of columns, defaults to a roughly square sheet
+    :return:        PIL image
+    """
+    from PIL import ImageDraw
+    n = len(images)
+    columns = columns if columns is not None else max(1, int(math.ceil(math.sqrt(n))))
+    rows = max(1, int(math.ceil(n / columns)))
+    label_height = 16
+    pad = 4
+    cell = (tile[0] + 2 * pad, tile[1] + label_height + 2 * pad)
+    sheet = Image.new('RGB', (columns * cell[0], rows * cell[1]), background)
+    draw = ImageDraw.Draw(sheet)
+    for i, (img, label) in enumerate(zip(images, labels)):
+        x = (i % columns) * cell[0] + pad
+        y = (i // columns) * cell[1] + pad
+        if img is None:
+            draw.rectangle((x, y, x + tile[0] - 1, y + tile[1] - 1), outline=(160, 0, 0))
+        else:
+            thumb = img.rendition(tile)
+            sheet.paste(thumb, (x + (tile[0] - thumb.size[0]) // 2, y + (tile[1] - thumb.size[1]) // 2))
+        draw.text((x, y + tile[1] + 2), label, fill=(230, 230, 230))
+    return sheet
@@ -0,0 +1,209 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from Communication import RaspiStillCommClass
+
+
+class _TriggerPoint:
+    """
+    Barrier shared by the cameras of one rig capture. Records when each camera was released, so the trigger skew can be reported.
+    """
+    def __init__(self, n, timeout):
+        self._barrier = threading.Barrier(max(1, n), timeout=timeout)
+        self.released = {}
+
+    def waiter(self, ip):
+        """
+        Returns an object with a wait() method, to be passed as sync to RaspiStillCommClass.capture
+        """
+        point = self
+
+        class Waiter:
+            def wait(self):
+                point._barrier.wait()
+                point.released[ip] = time.time()
+        return Waiter()
+
+    def abort(self):
+        self._barrier.abort()
+
+
+class HostResult:
+    """
+    Outcome of one operation on one host of the fleet
+    """
+    def __init__(self, ip):
+        self.ip = ip
+        self.latency = None
+        self.error = None
+        self.image = None
+
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.ok():
+            return '%s: %.2f s' % (self.ip, self.latency)
+        return '%s: failed after %.2f s (%s)' % (self.ip, self.latency, self.error)
+
+
+class FleetCapture:
+    """
+    Result of a capture on all cameras of the fleet
+    """
+    def __init__(self, results, elapsed, skew):
+        self.results = results
+        self.elapsed = elapsed
+        self.skew = skew
+
+    def failed(self):
+        return [res for res in self.results.values() if not res.ok()]
+
+    def slowest(self):
+        """
+        Latency of the slowest successful camera, which is what the total capture time should be close to
+        """
+        latencies = [res.latency for res in self.results.values() if res.ok()]
+        return max(latencies) if latencies else 0.0
+
+    def __str__(self):
+        lines = ['%d cameras in %.2f s (slowest %.2f s, trigger skew %.1f ms), %d failed'
+                 % (len(self.results), self.elapsed, self.slowest(), 1000 * self.skew, len(self.failed()))]
+        lines += ['  ' + str(res) for res in self.results.values()]
+        return '\n'.join(lines)
+
+
+class CameraFleet:
+    """
+    Class for controlling a rig of RPi cameras.
+    Keeps one RaspiStillCommClass connection per camera open and runs operations on all of them concurrently from a thread pool,
+    so a rig capture takes about as long as the slowest camera.
+    """
+    def __init__(self, hosts, remote_dir, local_dir=None, log=False, hot=True, sync_timeout=30, settings=None):
+        """
+        :param hosts:           list of (ip, port, user, pswd). Cameras are keyed by 'ip:port'.
+        :param remote_dir:      workspace on every RPi
+        :param local_dir:       images from each camera go into local_dir/<ip>_<port>, defaults to the current working directory
+        :param hot:             keep raspistill running on the cameras, which makes the synchronised trigger a single write per camera
+        :param sync_timeout:    seconds to wait for all cameras to become ready before a capture is abandoned
+        :param settings:        SshSettings used for every camera, defaults to SshSettings()
+        """
+        self._hosts = hosts
+        self._remote_dir = remote_dir
+        self._local_dir = local_dir if local_dir is not None else os.getcwd()
+        self._log = log
+        self._hot = hot
+        self._sync_timeout = sync_timeout
+        self._settings = settings
+        self._pool = ThreadPoolExecutor(max_workers=max(1, len(hosts)))
+        self._cams = {}
+
+    def __del__(self):
+        self.close()
+
+    def _map(self, ips, fn):
+        """
+        Runs fn(ip) for every camera key 'ip:port' concurrently and returns a dict of HostResult, keyed like the cameras
+        """
+        def run(ip):
+            res = HostResult(ip)
+            t0 = time.time()
+            try:
+                res.image = fn(ip)
+            except Exception as e:
+                res.error = e
+            res.latency = time.time() - t0
+            return res
+        futures = [self._pool.submit(run, ip) for ip in ips]
+        results = [f.result() for f in futures]
+        return {res.ip: res for res in results}
+
+    def connect(self):
+        """
+        Opens connections to all cameras which are not connected yet. Returns a dict of HostResult with the connection latency.
+        """
+        todo = {'%s:%d' % (ip, port): (ip, port, user, pswd) for ip, port, user, pswd in self._hosts}
+        todo = {key: host for key, host in todo.items() if key not in self._cams}
+
+        def connect(key):
+            ip, port, user, pswd = todo[key]
+            cam = RaspiStillCommClass(ip, user, pswd, self._remote_dir, log=self._log, port=port, settings=self._settings, hot=self._hot)
+            cam.local_dir = os.path.join(self._local_dir, '%s_%d' % (ip, port))
+            os.makedirs(cam.local_dir, exist_ok=True)
+            self._cams[key] = cam
+        return self._map(list(todo), connect)
+
+    def cameras(self):
+        """
+        Returns the connected cameras, keyed by 'ip:port'
+        """
+        return dict(self._cams)
+
+    def setOption(self, name, value):
+        """
+        Sets a named option to a given value on all cameras
+        """
+        for cam in self._cams.values():
+            cam.setOption(name, value)
+
+    def capture(self):
+        """
+        Captures an image on all connected cameras.
+        Every camera is first made ready (the hot raspistill started if needed) and then the ready ones are released from a barrier at once,
+        so the trigger skew is the spread of a single ssh write rather than of a full camera start.
+        Images are transferred in parallel. The returned FleetCapture holds the local image of each camera in HostResult.image.
+        """
+        t0 = time.time()
+        if self._hot:
+            results = self._map(list(self._cams), lambda ip: self._cams[ip].startHotCamera())
+        else:
+            results = {ip: HostResult(ip) for ip in self._cams}
+        ips = [ip for ip, res in results.items() if res.ok()]
+        trigger = _TriggerPoint(len(ips), self._sync_timeout)
+
+        def capture(ip):
+            cam = self._cams[ip]
+            try:
+                cam.capture(sync=trigger.waiter(ip))
+            except Exception:
+                # do not leave the other cameras waiting for one that will never arrive
+                trigger.abort()
+                raise
+            return cam.getCapturedImage()
+
+        results.update(self._map(ips, capture))
+        elapsed = time.time() - t0
+        released = list(trigger.released.values())
+        skew = max(released) - min(released) if released else 0.0
+        return FleetCapture(results, elapsed, skew)
+
+    def close(self):
+        """
+        Closes all connections
+        """
+        cams, self._cams = self._cams, {}
+        for cam in cams.values():
+            try:
+                cam.stopHotCamera()
+                cam.close()
+            except Exception:
+                pass
+        self._pool.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Capture on a rig of Raspberry Pi HQ cameras')
+    parser.add_argument('remote_dir', help='Workspace for this program on every RPi')
+    parser.add_argument('hosts', nargs='+', help='Cameras as ip:port:user:pswd')
+    args = parser.parse_args()
+    hosts = []
+    for host in args.hosts:
+        ip, port, user, pswd = host.split(':', 3)
+        hosts.append((ip, int(port), user, pswd))
+    fleet = CameraFleet(hosts, args.remote_dir, log=True)
+    for res in fleet.connect().values():
+        print('connect ' + str(res))
+    print(fleet.capture())
+    fleet.close()
@@ -0,0 +1,113 @@
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+class CaptureTimings:
+    """
+    Class collecting the time spent in each stage of a single capture, from building the command to rendering the image.
+    Stages are recorded in seconds in the order they happen.
+    """
+    def __init__(self, mode=''):
+        """
+        :param mode:    free text describing how the capture was taken, e.g. 'hot' or 'stream'
+        """
+        self.started = time.time()
+        self.mode = mode
+        self.stages = OrderedDict()
+        self.bytes = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing the enclosed block as stage name
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name, seconds):
+        """
+        Adds seconds to stage name
+        """
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def throughput(self):
+        """
+        Transfer throughput in bytes per second, or None if no transfer was recorded
+        """
+        seconds = self.stages.get('transfer')
+        if self.bytes is None or not seconds:
+            return None
+        return self.bytes / seconds
+
+    def total(self):
+        return sum(self.stages.values())
+
+    def toDict(self):
+        res = {'time': self.started, 'mode': self.mode, 'bytes': self.bytes, 'throughput': self.throughput()}
+        res.update(('%s_s' % name, round(seconds, 6)) for name, seconds in self.stages.items())
+        res['total_s'] = round(self.total(), 6)
+        return res
+
+
+class MetricsLog:
+    """
+    Class keeping a rolling window of CaptureTimings and optionally appending each one as a JSON line to a file
+    """
+    def __init__(self, path=None, window=100):
+        """
+        :param path:    JSON lines file to append to, None for no file
+        :param window:  number of captures the percentiles are computed over
+        """
+        self._path = path
+        self._window = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, timings):
+        with self._lock:
+            self._window.append(timings)
+            if self._path is not None:
+                with open(self._path, 'a') as f:
+                    f.write(json.dumps(timings.toDict()) + '\n')
+
+    def last(self):
+        with self._lock:
+            return self._window[-1] if self._window else None
+
+    def percentiles(self, stage, ps=(50, 95)):
+        """
+        Returns the given percentiles of a stage over the window (nearest rank), or None if the stage was never recorded
+        """
+        with self._lock:
+            values = sorted(t.stages[stage] for t in self._window if stage in t.stages)
+        if not values:
+            return None
+        return tuple(values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] for p in ps)
+
+    def stageNames(self):
+        with self._lock:
+            names = OrderedDict()
+            for t in self._window:
+                names.update((name, None) for name in t.stages)
+        return list(names)
+
+    def summary(self):
+        """
+        Text table of the last capture and the rolling p50/p95 of every stage, in milliseconds
+        """
+        last = self.last()
+        if last is None:
+            return 'no captures yet'
+        lines = ['%-10s %8s %8s %8s' % ('stage', 'last', 'p50', 'p95')]
+        for name in self.stageNames():
+            p50, p95 = self.percentiles(name)
+            cur = '%8.1f' % (1000 * last.stages[name]) if name in last.stages else '%8s' % '-'
+            lines.append('%-10s %s %8.1f %8.1f' % (name, cur, 1000 * p50, 1000 * p95))
+        if last.throughput() is not None:
+            lines.append('%d kB at %.0f kB/s' % (last.bytes / 1000, last.throughput() / 1000))
+        return '\n'.join(lines)
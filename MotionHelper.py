@@ -0,0 +1,225 @@
+"""
+Change detection helper, copied to the RPi and run there by RaspiStillCommClass.watch.
+
+Low resolution luma frames from raspividyuv, or from a fake source for testing, are compared in blocks with a reference
+which slowly follows the scene. When enough blocks have changed, a MOTION line is printed and the camera is released,
+so the host can capture and transfer a full resolution still. Watching resumes when a line arrives on stdin.
+Nothing but these lines crosses the link while the scene is still.
+
+    python3 MotionHelper.py --width 320 --height 240 --fps 5 --threshold 12 --fraction 0.01 --cooldown 5
+    python3 MotionHelper.py --fps 0 --fake still:20,move:5,still:20,light:3,still:10
+
+Lines on stdout:
+    READY <width> <height>
+    MOTION <frame number> <fraction of blocks changed> <mean difference in the changed blocks>
+    END <frames compared>       when the source has run out or stdin was closed
+Any line on stdin resumes after MOTION, closing stdin stops the helper.
+Needs numpy on the RPi: sudo apt install python3-numpy
+"""
+import sys
+import time
+import queue
+import argparse
+import threading
+import subprocess
+try:
+    import numpy as np
+except ImportError:
+    sys.stderr.write('The motion helper needs numpy on the Raspberry Pi: sudo apt install python3-numpy\n')
+    sys.exit(2)
+
+
+class RaspividSource:
+    """
+    Luma planes of the YUV420 frames raspividyuv writes to stdout.
+    Rows are padded to a multiple of 32 bytes and planes to a multiple of 16 rows.
+    """
+    def __init__(self, width, height, fps):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self._stride = (width + 31) & ~31
+        self._rows = (height + 15) & ~15
+        self._frame_size = self._stride * self._rows * 3 // 2
+        self._proc = None
+
+    def start(self):
+        self._proc = subprocess.Popen(['raspividyuv', '-n', '-t', '0', '-w', str(self.width), '-h', str(self.height),
+                                       '-fps', str(self.fps or 30), '-o', '-'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def read(self):
+        """
+        Returns the next luma plane as a (height, width) uint8 array, or None if raspividyuv has ended
+        """
+        data = self._proc.stdout.read(self._frame_size)
+        if len(data) < self._frame_size:
+            return None
+        return np.frombuffer(data, dtype=np.uint8, count=self._stride * self._rows).reshape(self._rows, self._stride)[:self.height, :self.width]
+
+    def stop(self):
+        """
+        Stops raspividyuv, which releases the camera
+        """
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.wait()
+            self._proc = None
+
+
+class FakeSource:
+    """
+    Synthetic frames following a script of comma separated kind:count segments, for testing without a camera:
+        still   the scene with sensor noise
+        move    a bright square moving across the scene
+        light   the scene brightened for good, i.e. a scene change
+    """
+    def __init__(self, width, height, fps, script, seed=0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self._rng = np.random.default_rng(seed)
+        y, x = np.mgrid[0:height, 0:width]
+        self._scene = (60 + 80 * x / width + 40 * np.sin(y / 9.0)).astype(np.float32)
+        self._frames = []
+        for segment in script.split(','):
+            kind, _, count = segment.partition(':')
+            if kind not in ('still', 'move', 'light'):
+                raise ValueError('Unknown fake frame kind: ' + kind)
+            self._frames += [kind] * int(count or 1)
+        self._index = 0
+        self._last = None
+
+    def start(self):
+        pass
+
+    def read(self):
+        if self._index >= len(self._frames):
+            return None
+        if self.fps and self._last is not None:
+            time.sleep(max(0.0, 1.0 / self.fps - (time.time() - self._last)))
+        self._last = time.time()
+        kind = self._frames[self._index]
+        self._index += 1
+        if kind == 'light':
+            self._scene += 40 / max(1, self._frames.count('light'))
+        frame = self._scene + self._rng.normal(0, 2, self._scene.shape)
+        if kind == 'move':
+            size = max(8, self.height // 6)
+            x = (self._index * size // 2) % (self.width - size)
+            y = self.height // 3
+            frame[y:y + size, x:x + size] = 230
+        return np.clip(frame, 0, 255).astype(np.uint8)
+
+    def stop(self):
+        pass
+
+
+class ChangeDetector:
+    """
+    Compares frames with a reference in blocks. The mean absolute difference of each block is compared with threshold,
+    and the fraction of blocks above it is the change. The reference follows the scene with weight adapt per frame,
+    so slow changes of light are absorbed while anything sudden stands out.
+    """
+    def __init__(self, block=16, threshold=12, adapt=0.05):
+        self.block = block
+        self.threshold = threshold
+        self.adapt = adapt
+        self._reference = None
+
+    def reset(self):
+        """
+        Makes the next frame the reference
+        """
+        self._reference = None
+
+    def update(self, frame):
+        """
+        Returns (fraction of changed blocks, mean difference of the changed blocks) of a frame and updates the reference
+        """
+        b = self.block
+        h, w = (frame.shape[0] // b) * b, (frame.shape[1] // b) * b
+        current = frame[:h, :w].astype(np.float32)
+        if self._reference is None:
+            self._reference = current
+            return 0.0, 0.0
+        blocks = np.abs(current - self._reference).reshape(h // b, b, w // b, b).mean(axis=(1, 3))
+        changed = blocks > self.threshold
+        self._reference += self.adapt * (current - self._reference)
+        if not changed.any():
+            return 0.0, 0.0
+        return float(changed.mean()), float(blocks[changed].mean())
+
+
+def _readCommands(commands, closed):
+    for line in sys.stdin:
+        commands.put(line.strip())
+    closed.set()
+    commands.put(None)
+
+
+def watch(source, detector, fraction, cooldown, settle):
+    """
+    Runs the detection loop until the source ends or stdin is closed
+
+    :param fraction:    fraction of changed blocks which counts as motion
+    :param cooldown:    seconds after a capture during which no motion is reported
+    :param settle:      frames skipped after the camera is started, while exposure settles
+    :return:            number of frames compared
+    """
+    commands = queue.Queue()
+    closed = threading.Event()
+    threading.Thread(target=_readCommands, args=(commands, closed), daemon=True).start()
+    print('READY %d %d' % (source.width, source.height), flush=True)
+    frames = 0
+    skip = settle
+    quiet_until = 0.0
+    source.start()
+    try:
+        while not closed.is_set():
+            frame = source.read()
+            if frame is None:
+                break
+            if skip > 0:
+                skip -= 1
+                detector.reset()
+                continue
+            frames += 1
+            changed, level = detector.update(frame)
+            if changed < fraction or time.time() < quiet_until:
+                continue
+            # raspistill needs the camera
+            source.stop()
+            print('MOTION %d %.4f %.1f' % (frames, changed, level), flush=True)
+            if commands.get() is None:
+                return frames
+            detector.reset()
+            skip = settle
+            quiet_until = time.time() + cooldown
+            source.start()
+    finally:
+        source.stop()
+    return frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report scene changes seen by the Raspberry Pi camera on stdout')
+    parser.add_argument('--width', type=int, default=320, help='Width of the compared frames')
+    parser.add_argument('--height', type=int, default=240, help='Height of the compared frames')
+    parser.add_argument('--fps', type=float, default=5, help='Frames compared per second, 0 for as fast as possible with --fake')
+    parser.add_argument('--block', type=int, default=16, help='Size of the compared blocks in pixels')
+    parser.add_argument('--threshold', type=float, default=12, help='Mean difference of a block which counts as changed, 0-255')
+    parser.add_argument('--fraction', type=float, default=0.01, help='Fraction of changed blocks which counts as motion')
+    parser.add_argument('--cooldown', type=float, default=5, help='Seconds after a capture during which no motion is reported')
+    parser.add_argument('--settle', type=int, default=3, help='Frames skipped after starting the camera')
+    parser.add_argument('--fake', default=None, help='Use a fake frame source following this script, e.g. still:20,move:5')
+    args = parser.parse_args(argv)
+    if args.fake is not None:
+        source = FakeSource(args.width, args.height, args.fps, args.fake)
+    else:
+        source = RaspividSource(args.width, args.height, args.fps)
+    frames = watch(source, ChangeDetector(args.block, args.threshold), args.fraction, args.cooldown, args.settle)
+    print('END %d' % frames, flush=True)
+
+
+if __name__ == '__main__':
+    main()
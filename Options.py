@@ -41,6 +41,18 @@ class Option:
     def getSetBudy(self):
         return self._set_budy
 
+    def getArguments(self):
+        """
+        Returns the command line arguments for the current value
+        """
+        return self.command + ' ' + str(self.value)
+
+    def accepts(self, value):
+        """
+        True if value is a valid value of the option
+        """
+        return True
+
 
 class IntOption(Option):
     """
@@ -51,6 +63,12 @@ class IntOption(Option):
         self.lb = lb
         self.ub = ub
 
+    def accepts(self, value):
+        try:
+            return self.lb <= int(value) <= self.ub
+        except ValueError:
+            return False
+
 class GenericOption(Option):
     """
     Class defining String options
@@ -59,3 +77,31 @@ class GenericOption(Option):
         super(GenericOption, self).__init__(command, name, descr, default)
         self.potential_values = potential_values
 
+    def accepts(self, value):
+        return str(value) in [str(v) for v in self.potential_values]
+
+class FlagOption(GenericOption):
+    """
+    Class defining on/off options, which are passed without a value
+    """
+    def __init__(self, command, name, descr, default):
+        super(FlagOption, self).__init__(command, name, descr, ["off", "on"], default)
+
+    def getArguments(self):
+        return self.command if self.value == "on" else ''
+
+
+def parseGrid(text):
+    """
+    Parses a sweep grid like 'ISO=100,400,800; EV=-2,0,2' into {'ISO': ['100', '400', '800'], 'EV': ['-2', '0', '2']}.
+    An option without values, e.g. 'awb', stands for all its values.
+    """
+    grid = {}
+    for part in text.split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, values = part.partition('=')
+        values = [v.strip() for v in values.split(',') if v.strip()]
+        grid[name.strip()] = values if values else None
+    return grid
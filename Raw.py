@@ -0,0 +1,94 @@
+import os
+import ctypes
+from Communication import findJpegEnd
+
+
+class BroadcomRawHeader(ctypes.Structure):
+    """
+    Header raspistill -r writes in front of the raw Bayer data, 176 bytes into the 'BRCM' block
+    """
+    _fields_ = [
+        ('name', ctypes.c_char * 32),
+        ('width', ctypes.c_uint16),
+        ('height', ctypes.c_uint16),
+        ('padding_right', ctypes.c_uint16),
+        ('padding_down', ctypes.c_uint16),
+        ('dummy', ctypes.c_uint32 * 6),
+        ('transform', ctypes.c_uint16),
+        ('format', ctypes.c_uint16),
+        ('bayer_order', ctypes.c_uint8),
+        ('bayer_format', ctypes.c_uint8),
+    ]
+
+
+# bits per pixel of the raw data of each sensor
+SENSOR_BPP = {'ov5647': 10, 'imx219': 10, 'imx477': 12, 'testc': 12}
+# CFA pattern of each bayer_order in the header, as DNG colour indices
+BAYER_ORDER = {0: [0, 1, 1, 2], 1: [1, 2, 0, 1], 2: [2, 1, 1, 0], 3: [1, 0, 2, 1]}
+_HEADER_SIZE = 32768
+_HEADER_OFFSET = 176
+
+
+def findRaw(data):
+    """
+    Returns the index of the raw Bayer block appended to a JPEG by raspistill -r, or -1 if there is none
+
+    :param data:    bytes of the captured JPEG
+    """
+    end = findJpegEnd(data, 0) if data[:2] == b'\xff\xd8' else -1
+    if end < 0 or data[end:end + 4] != b'BRCM':
+        return -1
+    return end
+
+
+def hasRaw(data):
+    return findRaw(data) >= 0
+
+
+def rawInfo(data):
+    """
+    Returns (sensor, width, height, bits per pixel, stride) of the raw Bayer data in a JPEG
+    """
+    start = findRaw(data)
+    if start < 0:
+        raise Exception('Image holds no raw data, capture with the raw option on.')
+    header = BroadcomRawHeader.from_buffer_copy(data, start + _HEADER_OFFSET)
+    sensor = header.name.decode(encoding='ascii', errors='replace')
+    sensor = sensor[3:] if sensor.startswith('RP_') else sensor
+    if sensor not in SENSOR_BPP:
+        raise Exception('Unknown camera sensor in raw data: ' + sensor)
+    bpp = SENSOR_BPP[sensor]
+    # pixels are packed and every row is padded to a multiple of 32 bytes
+    stride = ((header.width * bpp // 8) + 31) & ~31
+    return sensor, header.width, header.height, bpp, stride
+
+
+def toDng(data, path):
+    """
+    Converts the raw Bayer data of a JPEG captured with raspistill -r to a DNG file.
+    Needs numpy and PiDNG (pip install pidng), which are imported here as they are only needed for this.
+
+    :param data:    bytes of the captured JPEG
+    :param path:    DNG file to write
+    :return:        path of the written file
+    """
+    try:
+        import numpy as np
+        from pidng.core import RPICAM2DNG
+        from pidng.camdefs import RaspberryPiHqCamera
+    except ImportError:
+        raise Exception('Converting raw captures to DNG needs numpy and PiDNG: pip install pidng')
+    sensor, width, height, bpp, stride = rawInfo(data)
+    if sensor not in ('imx477', 'testc'):
+        raise Exception('DNG conversion is only supported for the HQ camera, not for ' + sensor)
+    start = findRaw(data)
+    # there are a few padding rows at the end, which are cut off when unpacking
+    rows = (len(data) - start - _HEADER_SIZE) // stride
+    bayer = np.frombuffer(data, dtype=np.uint8, count=rows * stride, offset=start + _HEADER_SIZE).reshape(rows, stride)
+    header = BroadcomRawHeader.from_buffer_copy(data, start + _HEADER_OFFSET)
+    # raspistill always writes the full sensor, which is sensor mode 3
+    model = RaspberryPiHqCamera(3, cfaPattern=BAYER_ORDER.get(header.bayer_order, BAYER_ORDER[2]))
+    model.fmt = {'size': (width, height), 'stride': stride, 'bpp': bpp, 'format': 'CSI2P'}
+    dng = RPICAM2DNG(model)
+    dng.options(os.path.dirname(os.path.abspath(path)), compress=False)
+    return dng.convert(bayer, os.path.basename(path))
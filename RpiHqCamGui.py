@@ -1,35 +1,124 @@
 import tkinter as tk
 from tkinter import ttk
 import tkinter.filedialog as filedialog
-from Communication import *
+import io
+import os
+import math
+from collections import OrderedDict
+from Communication import RaspiStillCommClass, SshSettings
 import Options as op
-from PIL import ImageTk, Image
 from ToolTip import CreateToolTip
+from Worker import Worker
+from Metrics import MetricsLog
+from Archive import CaptureArchive
+# PIL and paramiko are imported where they are first needed, so the window shows up without waiting for them
 
 class RpiHqCamGui:
     """
     Class for handling the GUI for the RPi HQ camera
     """
+    # width of the histogram panel next to the picture
+    PANEL_WIDTH = 276
+    # size of a thumbnail in the filmstrip, including its border
+    STRIP_CELL = (96, 76)
+    # zoom steps of the tiled viewer in screen pixels per image pixel, powers of 2 so levels of the TilePyramid are shown 1:1
+    ZOOMS = (1 / 8, 1 / 4, 1 / 2, 1, 2, 4)
 
-    def __init__(self, ip, user, pswd, remote_dir, log=False):
+    def __init__(self, ip, user, pswd, remote_dir, log=False, hot=False, stream=False, metrics=None, settings=None, budget=None, lossy=False,
+                 archive=None, archive_size=2000 * 10**6):
+        """
+        :param metrics:         JSON lines file the stage timings of every capture are appended to
+        :param settings:        SshSettings of the connection to the RPi
+        :param budget:          seconds within which a captured image should be shown, see RaspiStillCommClass.setAdaptive
+        :param lossy:           meet the budget by lowering quality and resolution instead of showing a thumbnail first
+        :param archive:         directory all captures are kept in, browsable in a filmstrip, see CaptureArchive.
+                                None keeps only the last capture.
+        :param archive_size:    bytes the archive may take on disk
+        """
         self._root = tk.Tk()
         self._root.title("RPi HQ Camera")
         self._root.geometry('10000x3000')
         self._settingsFrame = ttk.Frame(self._root)
         self._picFrame = ttk.Frame(self._root)
-        self._pic = tk.Label(self._picFrame, image=None)
+        self._pic = tk.Canvas(self._picFrame, highlightthickness=0)
+        self._pic.bind('<ButtonPress-1>', self._startRoi)
+        self._pic.bind('<B1-Motion>', self._dragRoi)
+        self._pic.bind('<ButtonRelease-1>', self._endRoi)
+        self._pic.bind('<Double-Button-1>', self._toggleZoom)
+        self._pic.bind('<MouseWheel>', lambda event: self._zoomAt(event.x, event.y, 1 if event.delta > 0 else -1))
+        self._pic.bind('<Button-4>', lambda event: self._zoomAt(event.x, event.y, 1))
+        self._pic.bind('<Button-5>', lambda event: self._zoomAt(event.x, event.y, -1))
+        self._panel = tk.Canvas(self._picFrame, width=self.PANEL_WIDTH, highlightthickness=0, bg='black')
+        self._strip = tk.Canvas(self._root, height=self.STRIP_CELL[1], highlightthickness=0, bg='black')
+        self._strip.bind('<Button-1>', self._clickStrip)
+        self._strip.bind('<MouseWheel>', lambda event: self._stepFrame(-1 if event.delta > 0 else 1))
+        self._strip.bind('<Button-4>', lambda event: self._stepFrame(-1))
+        self._strip.bind('<Button-5>', lambda event: self._stepFrame(1))
+        self._statusFrame = ttk.Frame(self._root)
+        self._progress = ttk.Progressbar(self._statusFrame, mode='indeterminate', length=200)
+        self._status = ttk.Label(self._statusFrame, text='')
+        self._cancelBtn = ttk.Button(self._statusFrame, text='Cancel', command=self._cancelCapture)
+        self._connectBtn = ttk.Button(self._statusFrame, text='Connect', command=self._connect)
+        self._progress.pack(side='left')
+        self._cancelBtn.pack(side='left')
+        self._status.pack(side='left', fill='x', expand=1)
+        self._statusFrame.pack(side='bottom', fill='x')
         self._settingsFrame.pack()
         self._picFrame.pack()
-        self._comObj = RaspiStillCommClass(ip, user, pswd, remote_dir, log=log)
+        # the options are known without a connection, the connection is opened in the background by run
+        self._comObj = RaspiStillCommClass(ip, user, pswd, remote_dir, log=log, hot=hot, stream=stream, connect=False, settings=settings)
+        self._comObj.setAdaptive(budget, lossy)
+        self._comObj.on_original = self._onOriginal
+        self._archive = CaptureArchive(archive, archive_size) if archive is not None else None
+        self._comObj.setArchive(self._archive)
+        self._frame = None
+        self._stripFirst = 0
+        # PhotoImages of filmstrip thumbnails and decoded frames with their analysis, so browsing back and forth decodes nothing twice
+        self._thumbs = OrderedDict()
+        self._frames = OrderedDict()
+        # tiled viewer: zoom None shows the whole picture, otherwise the image point at the centre of the view is in _center
+        self._zoom = None
+        self._center = None
+        self._pyramid = None
+        self._tiles = OrderedDict()
+        self._panStart = None
+        self._ip = ip
+        self._connecting = False
+        self._captureButtons = []
         self._img = None
+        self._shownBox = None
+        self._shownSize = None
+        self._roiStart = None
+        self._roi = None
+        self._loupe = None
+        self._awaitingOriginal = None
+        self._refreshAfter = None
+        self._metrics = MetricsLog(metrics)
+        self._overlay = False
+        self._analyser = None
+        self._analysis = None
+        self._showAnalysis = True
+        self._clipping = False
+        self._preview = None
+        self._previewCount = 0
+        self._previewAfter = None
+        self._transferProgress = None
+        self._progressAfter = None
+        self._worker = Worker(self._root, on_busy=self._setBusy)
         # Every setting corresponds to one variable in GUI.
         # self._optVars establishes this pairing
         options = self._comObj.getOptions()
         vars = [tk.IntVar(self._settingsFrame, name=opt.name) if isinstance(opt, op.IntOption) else tk.StringVar(self._settingsFrame, name=opt.name) for opt in options]
         self._optVars = list(zip(options, vars))
+        self._burstFrames = tk.IntVar(self._settingsFrame, value=10)
+        self._burstInterval = tk.DoubleVar(self._settingsFrame, value=0)
+        self._sweepGrid = tk.StringVar(self._settingsFrame, value='ISO=100,400,800; EV=-2,0,2')
         self._buttons = [ ttk.Button(self._settingsFrame, width=82) for _ in range(2) ]
     
     def __del__(self):
+        if self._preview is not None:
+            self._preview.stop()
+        self._worker.stop()
         del self._comObj
 
     def _copyCaptureCommand(self):
@@ -46,9 +135,20 @@ class RpiHqCamGui:
         """
         if self._img is None:
             return
-        filename = filedialog.asksaveasfile(mode='w', defaultextension=".jpeg")
+        import Raw
+        filetypes = [('JPEG', '*.jpeg')]
+        if Raw.hasRaw(self._img.data):
+            filetypes.append(('DNG (raw)', '*.dng'))
+        filename = filedialog.asksaveasfilename(defaultextension=".jpeg", filetypes=filetypes)
         if not filename:
             return
+        if filename.lower().endswith('.dng'):
+            # PiDNG appends .dng to a name which does not end in it exactly, e.g. x.DNG would become x.DNG.dng
+            filename = filename[:-4] + '.dng'
+            data = self._img.data
+            self._status.config(text='Converting to DNG...')
+            self._worker.submit(lambda: Raw.toDng(data, filename), lambda path: self._status.config(text='Saved ' + path), self._showError)
+            return
         self._img.save(filename)
 
     def _constructSettings(self):
@@ -91,23 +191,780 @@ class RpiHqCamGui:
         btn2 = ttk.Button(self._settingsFrame, width=82, text='Save picture')
         btn2.grid(row=r, column=0, columnspan=2)
         btn2.bind("<Button-1>", lambda event: self._savePic())
+        r += 2
+        burstFrame = ttk.Frame(self._settingsFrame)
+        burstFrame.grid(row=r, column=0, columnspan=2)
+        ttk.Label(burstFrame, text='frames').pack(side='left')
+        ttk.Spinbox(burstFrame, width=8, from_=1, to=100000, textvariable=self._burstFrames).pack(side='left')
+        ttk.Label(burstFrame, text='interval [s]').pack(side='left')
+        ttk.Spinbox(burstFrame, width=8, from_=0, to=86400, increment=0.5, textvariable=self._burstInterval).pack(side='left')
+        btn3 = ttk.Button(burstFrame, width=40, text='Run burst / time-lapse', state='disabled')
+        btn3.pack(side='left')
+        btn3.bind("<Button-1>", lambda event: self._runBurst())
+        r += 2
+        btn4 = ttk.Button(self._settingsFrame, width=82, text='Live preview (F5)', state='disabled')
+        btn4.grid(row=r, column=0, columnspan=2)
+        btn4.bind("<Button-1>", lambda event: self._togglePreview())
+        r += 2
+        sweepFrame = ttk.Frame(self._settingsFrame)
+        sweepFrame.grid(row=r, column=0, columnspan=2)
+        ttk.Label(sweepFrame, text='sweep').pack(side='left')
+        sweepEntry = ttk.Entry(sweepFrame, width=40, textvariable=self._sweepGrid)
+        sweepEntry.pack(side='left')
+        CreateToolTip(sweepEntry, 'Options and values to try, e.g. ISO=100,400,800; EV=-2,0,2. An option without values tries all its values.')
+        btn5 = ttk.Button(sweepFrame, width=34, text='Run sweep', state='disabled')
+        btn5.pack(side='left')
+        btn5.bind("<Button-1>", lambda event: self._runSweep())
+        self._captureButtons = [btn3, btn4, btn5]
+
+    def _connect(self):
+        """
+        Opens the connection to the RPi on the worker thread
+        """
+        self._connectBtn.pack_forget()
+        self._connecting = True
+        self._status.config(text='Connecting to ' + self._ip + '...')
+        self._worker.submit(self._comObj.connect, self._onConnected, self._onConnectFailed, key='connect')
+
+    def _onConnected(self, res=None):
+        """
+        Enables capturing once the connection is ready
+        """
+        self._connecting = False
+        self._status.config(text='Connected to ' + self._ip + ' - press <Return> to capture')
+        for btn in self._captureButtons:
+            btn.config(state='normal')
+        self._root.bind("<Return>", lambda event: self._getAndShowFoto(event))
+        self._root.bind('<F5>', lambda event: self._togglePreview())
+
+    def _onConnectFailed(self, err):
+        self._connecting = False
+        self._status.config(text='Could not connect to ' + self._ip + ': ' + str(err))
+        self._connectBtn.pack(side='left')
+
+    def _onDisconnected(self, err=None):
+        """
+        Offers to connect again once the connection is gone, e.g. after reopening a lost one failed
+        """
+        if self._connecting:
+            return
+        self._status.config(text='Not connected to ' + self._ip + (': ' + str(err) if err is not None else ''))
+        if not self._connectBtn.winfo_ismapped():
+            self._connectBtn.pack(side='left')
+
+    def _ready(self):
+        if self._comObj.connected():
+            return True
+        self._onDisconnected()
+        return False
+
+    def _runBurst(self):
+        """
+        Runs a burst/time-lapse on the worker thread and reports its statistics in the status bar
+        """
+        if not self._ready():
+            return
+        n = self._burstFrames.get()
+        interval = self._burstInterval.get()
+        self._worker.submit(lambda: self._comObj.burst(n, interval), self._showBurst, self._showError, key='burst')
+
+    def _showBurst(self, report):
+        self._status.config(text='Burst: ' + str(report))
+        # the frames went into the archive
+        self._drawStrip()
+
+    def _runSweep(self):
+        """
+        Captures every combination of the sweep grid on the worker thread and shows the frames as a contact sheet
+        """
+        if not self._ready():
+            return
+        try:
+            overrides = self._comObj.sweepGrid(op.parseGrid(self._sweepGrid.get()))
+        except Exception as e:
+            self._status.config(text='Invalid sweep: ' + str(e))
+            return
+        self._stopPreview()
+        self._status.config(text='Sweeping %d combinations...' % len(overrides))
+        self._worker.submit(lambda: self._sweepAndRender(overrides), self._showSweep, self._showError, key='sweep')
+
+    def _sweepAndRender(self, overrides):
+        """
+        Runs a sweep and renders its contact sheet. Runs on the worker thread.
+        """
+        from Display import CapturedImage, contactSheet
+        report = self._comObj.sweep(overrides, local_dir=self._comObj.local_dir)
+        images = [CapturedImage.fromSource(frame.path) if frame.path is not None else None for frame in report.frames]
+        labels = [frame.label() if frame.error is None else frame.label() + ' (failed)' for frame in report.frames]
+        buf = io.BytesIO()
+        contactSheet(images, labels).save(buf, 'JPEG', quality=90)
+        return CapturedImage(buf.getvalue()), report
+
+    def _showSweep(self, res):
+        img, report = res
+        self._awaitingOriginal = None
+        self._img = img
+        self._frame = None
+        self._shownBox = None
+        self._refreshFoto()
+        self._drawStrip()
+        self._status.config(text='Sweep: ' + str(report))
 
     def _showSettings(self):
         self._settingsFrame.pack()
         self._picFrame.pack_forget()
+        self._strip.pack_forget()
+
+    def _toggleSettings(self):
+        """
+        Switches between the settings and the last picture, which is shown again from its cached rendition without decoding
+        """
+        if self._settingsFrame.winfo_ismapped() and self._img is not None and self._preview is None:
+            self._refreshFoto()
+            self._showPicFrame()
+        else:
+            self._showSettings()
+
+    def _cacheFrame(self, frame, img, analysis, size=8):
+        self._frames[frame] = (img, analysis)
+        self._frames.move_to_end(frame)
+        while len(self._frames) > size:
+            self._frames.popitem(last=False)
+
+    def _stepFrame(self, delta):
+        """
+        Shows the archived frame delta frames before or after the one shown
+        """
+        if self._archive is None or len(self._archive) == 0 or self._preview is not None:
+            return
+        current = self._frame if self._frame is not None else len(self._archive)
+        self._showFrame(min(len(self._archive) - 1, max(0, current + delta)))
+
+    def _clickStrip(self, event):
+        if self._archive is None:
+            return
+        frame = self._stripFirst + event.x // self.STRIP_CELL[0]
+        if frame < len(self._archive):
+            self._showFrame(frame)
+
+    def _showFrame(self, frame):
+        """
+        Shows an archived frame. Frames shown recently are still decoded; others are decoded on the worker,
+        with their filmstrip thumbnail standing in until then. Evicted frames only have their thumbnail.
+        """
+        self._stopPreview()
+        self._frame = frame
+        self._awaitingOriginal = None
+        entry = self._archive.frame(frame)
+        self._status.config(text='Frame %d/%d  %s  %dx%d %d kB  %s' % (frame + 1, len(self._archive), entry['time'], entry['width'], entry['height'],
+                                                                       entry['size'] / 1000, entry['command'] or ''))
+        if frame in self._frames:
+            self._frames.move_to_end(frame)
+            self._img, self._analysis = self._frames[frame]
+        elif self._archive.path(frame) is not None:
+            box = self._displayBox()
+            # while a load is waiting, browsing on only changes the frame it picks up
+            self._worker.submit(lambda: self._loadFrame(box), self._showLoadedFrame, self._showError, key='frame')
+            if self._zoom is not None:
+                # the zoomed view stays on the previous frame until this one is decoded, instead of falling back to its thumbnail
+                self._drawStrip()
+                return
+            from Display import CapturedImage
+            self._img = CapturedImage(self._archive.thumbnail(frame))
+            self._analysis = None
+        else:
+            from Display import CapturedImage
+            self._img = CapturedImage(self._archive.thumbnail(frame))
+            self._analysis = None
+            self._status.config(text=self._status.cget('text') + '  (evicted, thumbnail only)')
+        self._shownBox = None
+        self._refreshFoto()
+
+    def _loadFrame(self, box):
+        """
+        Decodes the archived frame to be shown and analyses it. Runs on the worker thread.
+        """
+        from Display import CapturedImage
+        frame = self._frame
+        path = self._archive.path(frame) if frame is not None else None
+        if path is None:
+            return frame, None, None
+        img = CapturedImage.fromSource(path)
+        img.rendition(box)
+        return frame, img, self._analyse(img, box)
+
+    def _showLoadedFrame(self, res):
+        frame, img, analysis = res
+        if img is None:
+            return
+        self._cacheFrame(frame, img, analysis)
+        if frame != self._frame:
+            return
+        self._img = img
+        self._analysis = analysis
+        self._shownBox = None
+        self._refreshFoto()
+
+    def _thumbnail(self, frame):
+        """
+        Returns the PhotoImage of the filmstrip thumbnail of a frame, decoded from the archive index once
+        """
+        if frame in self._thumbs:
+            self._thumbs.move_to_end(frame)
+            return self._thumbs[frame]
+        from PIL import Image, ImageTk
+        img = Image.open(io.BytesIO(self._archive.thumbnail(frame)))
+        img.thumbnail((self.STRIP_CELL[0] - 6, self.STRIP_CELL[1] - 6))
+        photo = ImageTk.PhotoImage(img)
+        self._thumbs[frame] = photo
+        while len(self._thumbs) > 256:
+            self._thumbs.popitem(last=False)
+        return photo
+
+    def _drawStrip(self):
+        """
+        Draws the thumbnails of the archived frames around the one shown. Only the visible ones are drawn,
+        so the filmstrip costs the same for a thousand frames as for ten.
+        """
+        self._strip.delete('all')
+        if self._archive is None or len(self._archive) == 0:
+            return
+        n = len(self._archive)
+        count = max(1, self._root.winfo_width() // self.STRIP_CELL[0])
+        current = self._frame if self._frame is not None else n - 1
+        self._stripFirst = min(max(0, current - count // 2), max(0, n - count))
+        w, h = self.STRIP_CELL
+        for i, frame in enumerate(range(self._stripFirst, min(n, self._stripFirst + count))):
+            x = i * w
+            self._strip.create_image(x + w // 2, h // 2, image=self._thumbnail(frame))
+            if self._archive.frame(frame).get('evicted'):
+                self._strip.create_rectangle(x + 3, 3, x + w - 3, h - 3, fill='gray20', stipple='gray50', outline='')
+            if frame == self._frame:
+                self._strip.create_rectangle(x + 1, 1, x + w - 2, h - 2, outline='yellow', width=2)
+
+    def _setBusy(self, busy):
+        """
+        Starts/stops the progress indicator
+        """
+        if busy:
+            self._progress.start(16)
+            self._pollProgress()
+        else:
+            self._progress.stop()
+            self._progress.config(mode='indeterminate', value=0)
+            self._transferProgress = None
+            if self._progressAfter is not None:
+                self._root.after_cancel(self._progressAfter)
+                self._progressAfter = None
+
+    def _onTransferProgress(self, done, total):
+        """
+        Progress callback of a transfer. Runs on the worker thread, so only the state is stored and _pollProgress shows it.
+        """
+        self._transferProgress = (done, total)
+
+    def _pollProgress(self):
+        """
+        Shows the progress of large transfers as a determinate progress bar while the worker is busy
+        """
+        progress = self._transferProgress
+        if progress is not None and progress[1] > 1000000:
+            done, total = progress
+            if str(self._progress['mode']) != 'determinate':
+                self._progress.stop()
+                self._progress.config(mode='determinate', maximum=total)
+            self._progress.config(value=done)
+            self._status.config(text='Transferring %.1f of %.1f MB' % (done / 1e6, total / 1e6))
+        self._progressAfter = self._root.after(100, self._pollProgress)
+
+    def _cancelCapture(self):
+        """
+        Cancels pending and running captures. A running capture finishes on remote but is not shown.
+        """
+        self._worker.cancel()
+        self._status.config(text='Cancelled')
+
+    def _showError(self, err):
+        if not self._comObj.connected():
+            self._onDisconnected(err)
+            return
+        self._status.config(text='Capture failed: ' + str(err))
+
+    def _previewSize(self):
+        """
+        Size of the live preview: the largest 4:3 frame fitting the picture area, in multiples of 32 pixels
+        """
+        width = max(self._root.winfo_width(), 320)
+        height = max(self._root.winfo_height() - self._statusFrame.winfo_height(), 240)
+        width = min(width, int(height * 4 / 3), 1920)
+        width = max(32 * (width // 32), 320)
+        return width, 32 * (int(width * 3 / 4) // 32)
+
+    def _togglePreview(self):
+        """
+        Starts or stops the live preview
+        """
+        if self._preview is not None:
+            self._stopPreview()
+            return
+        if not self._ready():
+            return
+        width, height = self._previewSize()
+        self._worker.submit(lambda: self._comObj.startPreview(width, height), self._startRenderingPreview, self._showError, key='preview')
+
+    def _startRenderingPreview(self, stream):
+        self._preview = stream
+        self._zoom = None
+        self._previewCount = 0
+        self._picFrame.pack(fill='both', expand=1)
+        self._panel.pack_forget()
+        self._strip.pack_forget()
+        self._pic.pack(side='left', fill='both', expand=1)
+        self._settingsFrame.pack_forget()
+        self._renderPreview()
+
+    def _renderPreview(self):
+        """
+        Shows the newest preview frame, if there is one, and reschedules itself
+        """
+        if self._preview is None:
+            return
+        count, frame = self._preview.latestFrame()
+        if count != self._previewCount and frame is not None:
+            self._previewCount = count
+            from PIL import Image
+            self._display(Image.open(io.BytesIO(frame)))
+            self._status.config(text='Preview %.1f fps, %d kB/s' % (self._preview.fps(), self._preview.bandwidth() / 1000))
+        if not self._preview.running():
+            self._stopPreview()
+            self._status.config(text='Preview stopped on Raspberry Pi')
+            return
+        self._previewAfter = self._root.after(15, self._renderPreview)
+
+    def _stopPreview(self):
+        """
+        Stops rendering and queues stopping the stream on the worker, ahead of any capture queued after this call
+        """
+        stream = self._preview
+        self._preview = None
+        if self._previewAfter is not None:
+            self._root.after_cancel(self._previewAfter)
+            self._previewAfter = None
+        if stream is not None:
+            self._worker.submit(stream.stop)
 
     def _getAndShowFoto(self, event=''):
-        self._pic.config(image="")
-        self._pic.image = None
-        self._comObj.capture()
-        img = Image.open(self._comObj._local_img)
-        factor = min(self._picFrame.winfo_screenwidth() / img.size[0], self._picFrame.winfo_screenheight() / img.size[1])
-        self._img = img.resize((int(factor * img.size[0]), int(factor * img.size[1])), Image.ANTIALIAS)
-        img = ImageTk.PhotoImage(self._img)
-        self._pic.config(image=img)
+        """
+        Triggers a capture on the worker thread. Repeated triggers while a capture is in flight are coalesced into one.
+        A running preview is stopped, so the capture gets the camera.
+        """
+        if not self._ready():
+            return
+        self._stopPreview()
+        self._status.config(text='Capturing...')
+        box = self._displayBox()
+        self._worker.submit(lambda: self._captureAndDecode(box), self._showFoto, self._showError, key='capture')
+
+    def _startRoi(self, event):
+        if self._zoom is not None:
+            self._panStart = (event.x, event.y, self._center)
+            return
+        if self._shownSize is None:
+            return
+        self._roiStart = (event.x, event.y)
+        self._pic.delete('roi')
+
+    def _dragRoi(self, event):
+        if self._panStart is not None:
+            x, y, center = self._panStart
+            self._center = (center[0] - (event.x - x) / self._zoom, center[1] - (event.y - y) / self._zoom)
+            self._drawTiles()
+            return
+        if self._roiStart is None:
+            return
+        self._pic.delete('roi')
+        self._pic.create_rectangle(self._roiStart[0], self._roiStart[1], event.x, event.y, outline='red', width=2, tags='roi')
+
+    def _endRoi(self, event):
+        """
+        Captures the dragged rectangle at native resolution and shows it 1:1 in the loupe
+        """
+        self._panStart = None
+        if self._roiStart is None:
+            return
+        x0, y0 = self._roiStart
+        self._roiStart = None
+        x0, x1 = sorted((min(max(x0, 0), self._shownSize[0]), min(max(event.x, 0), self._shownSize[0])))
+        y0, y1 = sorted((min(max(y0, 0), self._shownSize[1]), min(max(event.y, 0), self._shownSize[1])))
+        if x1 - x0 < 5 or y1 - y0 < 5 or not self._ready():
+            self._pic.delete('roi')
+            return
+        w, h = self._shownSize
+        self._roi = self._comObj.roiFromDisplay((x0 / w, y0 / h, (x1 - x0) / w, (y1 - y0) / h))
+        self._focusCheck()
+
+    def _focusCheck(self):
+        """
+        Captures the last selected region of interest on the worker thread
+        """
+        roi = self._roi
+        self._worker.submit(lambda: self._captureFocusCheck(roi), self._showLoupe, self._showError, key='roi')
+
+    def _captureFocusCheck(self, roi):
+        """
+        Captures a region of interest. Runs on the worker thread.
+        The region only applies to this capture, so bursts, sweeps, watching and the copied command stay full frame.
+        """
+        from Display import CapturedImage
+        self._comObj.captureRoi(roi)
+        timings = self._comObj.last_timings
+        img = CapturedImage.fromSource(self._comObj.getCapturedImage())
+        with timings.stage('decode'):
+            decoded = img.decode()
+        return img, decoded, timings
+
+    def _showLoupe(self, res):
+        """
+        Shows a focus check capture 1:1 in a separate window. <Return> in that window captures the same region again.
+        """
+        captured, img, timings = res
+        if self._loupe is None or not self._loupe.winfo_exists():
+            self._loupe = tk.Toplevel(self._root)
+            self._loupe.title('Focus check')
+            self._loupe.label = tk.Label(self._loupe)
+            self._loupe.label.pack()
+            self._loupe.bind('<Return>', lambda event: self._focusCheck())
+        from PIL import ImageTk
+        with timings.stage('render'):
+            photo = ImageTk.PhotoImage(img)
+            self._loupe.label.config(image=photo)
+            self._loupe.label.image = photo
+            self._loupe.update_idletasks()
+        self._loupe.captured = captured
+        self._metrics.record(timings)
+        self._status.config(text='Focus check %dx%d, %d kB' % (img.size[0], img.size[1], len(captured.data) / 1000))
+
+    def _displayBox(self):
+        """
+        Size available for showing pictures
+        """
+        width = self._root.winfo_width()
+        height = self._root.winfo_height() - self._statusFrame.winfo_height()
+        if width < 32 or height < 32:
+            width, height = self._picFrame.winfo_screenwidth(), self._picFrame.winfo_screenheight()
+        if self._showAnalysis:
+            width = max(32, width - self.PANEL_WIDTH)
+        if self._archive is not None:
+            height = max(32, height - self.STRIP_CELL[1])
+        return width, height
+
+    def _captureAndDecode(self, box):
+        """
+        Captures an image and decodes a rendition fitting box. Runs on the worker thread.
+        """
+        from Display import CapturedImage
+        self._transferProgress = None
+        self._comObj.capture(progress=self._onTransferProgress)
+        timings = self._comObj.last_timings
+        img = CapturedImage.fromSource(self._comObj.getCapturedImage())
+        img.rendition(box, timings)
+        analysis = self._analyse(img, box, timings)
+        return img, timings, self._comObj.getOriginalPath(), analysis
+
+    def _analyse(self, img, box, timings=None):
+        """
+        Computes histograms, clipping and focus score of the rendition of img fitting box. Runs on the worker thread.
+        Returns None if numpy is not installed.
+        """
+        if self._analyser is None:
+            try:
+                from Analysis import Analyser
+            except ImportError:
+                return None
+            self._analyser = Analyser()
+        rendition = img.rendition(box)
+        if timings is None:
+            return self._analyser.analyse(rendition)
+        with timings.stage('analyse'):
+            return self._analyser.analyse(rendition)
+
+    def _showFoto(self, res):
+        """
+        Shows a captured image. Runs on the main thread.
+        """
+        img, timings, original, analysis = res
+        self._awaitingOriginal = original
+        self._status.config(text='' if original is None else 'Thumbnail shown, fetching the full quality original...')
+        self._img = img
+        self._analysis = analysis
+        self._frame = self._comObj.last_frame
+        if self._frame is not None:
+            self._cacheFrame(self._frame, img, analysis)
+        self._shownBox = None
+        with timings.stage('render'):
+            self._refreshFoto()
+            self._root.update_idletasks()
+        self._metrics.record(timings)
+        self._drawOverlay()
+
+    def _onOriginal(self, path):
+        """
+        Called from the background fetcher when the original of a thumbnail-first capture has arrived.
+        The original is decoded on the worker and replaces the thumbnail if that is still shown.
+        """
+        box = self._shownBox
+        self._worker.submit(lambda: self._loadOriginal(path, box), self._showOriginal)
+
+    def _loadOriginal(self, path, box):
+        from Display import CapturedImage
+        img = CapturedImage.fromSource(path)
+        analysis = None
+        if box is not None:
+            img.rendition(box)
+            analysis = self._analyse(img, box)
+        return path, img, analysis
+
+    def _showOriginal(self, res):
+        path, img, analysis = res
+        if path != self._awaitingOriginal:
+            self._drawStrip()
+            return
+        self._awaitingOriginal = None
+        self._img = img
+        if analysis is not None:
+            self._analysis = analysis
+        if self._archive is not None and len(self._archive) > 0 and self._archive.frame(len(self._archive) - 1)['file'] == os.path.basename(path):
+            self._frame = len(self._archive) - 1
+            self._cacheFrame(self._frame, img, self._analysis)
+        self._shownBox = None
+        self._refreshFoto()
+        self._status.config(text='Full quality original received: ' + path)
+
+    def _toggleOverlay(self):
+        self._overlay = not self._overlay
+        self._drawOverlay()
+
+    def _drawOverlay(self):
+        """
+        Draws the stage timings of the last capture and their rolling p50/p95 on top of the picture
+        """
+        self._pic.delete('overlay')
+        if not self._overlay:
+            return
+        text = self._pic.create_text(10, 10, anchor='nw', text=self._metrics.summary(), fill='yellow', font=('Courier', 10), tags='overlay')
+        bg = self._pic.create_rectangle(self._pic.bbox(text), fill='black', outline='', tags='overlay')
+        self._pic.tag_lower(bg, text)
+
+    def _toggleAnalysis(self):
+        self._showAnalysis = not self._showAnalysis
+        self._shownBox = None
+        self._refreshFoto()
+
+    def _toggleClipping(self):
+        self._clipping = not self._clipping
+        self._drawClipping()
+
+    def _drawClipping(self):
+        """
+        Draws clipped highlights in red and clipped shadows in blue on top of the picture
+        """
+        self._pic.delete('clipping')
+        if not self._clipping or self._analysis is None or self._preview is not None or self._shownSize is None or self._zoom is not None:
+            return
+        from PIL import ImageTk
+        img = ImageTk.PhotoImage(self._analysis.clippingOverlay(self._shownSize))
+        self._pic.create_image(0, 0, anchor='nw', image=img, tags='clipping')
+        self._pic.tag_raise('overlay')
+        self._pic.clipping = img
+
+    def _drawAnalysis(self):
+        """
+        Draws the RGB and luma histograms, clipping and focus score of the shown picture in the panel next to it
+        """
+        self._panel.delete('all')
+        res = self._analysis
+        if res is None:
+            self._panel.create_text(10, 10, anchor='nw', text='Analysis needs numpy', fill='white')
+            return
+        x0, y0, height = 10, 10, 120
+        self._panel.create_rectangle(x0 - 1, y0 - 1, x0 + 256, y0 + height, outline='gray30')
+        # the clipped end bins would flatten everything else, sqrt keeps dark and bright tails visible
+        peak = max(max(h[1:-1].max() for h in res.histograms.values()), 1)
+        for name, colour in (('red', 'red'), ('green', 'green2'), ('blue', 'DodgerBlue'), ('luma', 'white')):
+            hist = res.histograms[name]
+            points = []
+            for x, n in enumerate(hist):
+                points += [x0 + x, y0 + height - min(height, int(height * (n / peak) ** 0.5))]
+            self._panel.create_line(*points, fill=colour)
+        text = ('Highlights %6.2f %%\nShadows    %6.2f %%\nFocus      %8.1f\n\n%dx%d (1/%d) in %.1f ms\nF4 panel, F6 clipping'
+                % (100 * res.highlights, 100 * res.shadows, res.focus, res.size[0], res.size[1], res.step, 1000 * res.elapsed))
+        self._panel.create_text(x0, y0 + height + 10, anchor='nw', text=text, fill='white', font=('Courier', 10))
+
+    def _refreshFoto(self, event=None):
+        """
+        Shows the rendition of the current picture fitting the window. Renditions are cached, so resizing only decodes once per size.
+        """
+        if self._img is None or self._preview is not None:
+            return
+        box = self._displayBox()
+        if self._zoom is not None:
+            self._drawTiles()
+            return
+        if box == self._shownBox:
+            return
+        self._shownBox = box
+        self._display(self._img.rendition(box))
+
+    def _toggleZoom(self, event):
+        """
+        Switches between the whole picture and 100 % around the pointer
+        """
+        if self._zoom is None:
+            self._zoomAt(event.x, event.y, zoom=1)
+        else:
+            self._zoomAt(event.x, event.y, zoom=None)
+
+    def _zoomAt(self, x, y, steps=0, zoom=0):
+        """
+        Zooms in (steps > 0) or out by a number of ZOOMS steps, or to a given zoom, keeping the image point under (x, y) in place.
+        Zooming out beyond the whole picture goes back to showing the whole picture.
+        """
+        if self._img is None or self._preview is not None or self._shownSize is None:
+            return
+        fit = self._shownSize[0] / self._img.size()[0]
+        if self._zoom is None:
+            point = (x / fit, y / fit)
+            current = fit
+        else:
+            w, h = self._viewSize()
+            point = (self._center[0] + (x - w / 2) / self._zoom, self._center[1] + (y - h / 2) / self._zoom)
+            current = self._zoom
+        if zoom == 0:
+            if steps > 0:
+                zoom = next((z for z in self.ZOOMS if z > current * 1.01), self.ZOOMS[-1])
+            else:
+                zoom = next((z for z in reversed(self.ZOOMS) if z < current * 0.99), None)
+            if zoom is not None and zoom <= fit:
+                zoom = None
+        if zoom is None:
+            if self._zoom is not None:
+                self._zoom = None
+                self._shownBox = None
+                self._refreshFoto()
+            return
+        w, h = self._viewSize()
+        self._zoom = zoom
+        self._center = (point[0] - (x - w / 2) / zoom, point[1] - (y - h / 2) / zoom)
+        self._status.config(text='%g %%, drag to pan, wheel to zoom, double click for the whole picture' % (100 * zoom))
+        self._drawTiles()
+
+    def _viewSize(self):
+        w, h = self._pic.winfo_width(), self._pic.winfo_height()
+        return (w, h) if w > 1 and h > 1 else self._displayBox()
+
+    def _drawTiles(self):
+        """
+        Draws the visible tiles of the picture at the current zoom. Tiles are taken from the TilePyramid level matching the zoom,
+        so they are shown 1:1 up to 100 %, and their PhotoImages are kept in an LRU sized to a few screens.
+        A level which is not decoded yet is decoded on the worker, the whole picture scaled up stands in until then.
+        """
+        from PIL import Image, ImageTk
+        from Display import TilePyramid
+        if self._pyramid is None or self._pyramid.image is not self._img:
+            if self._pyramid is not None and self._pyramid.image.size() != self._img.size():
+                # a picture of a different size, e.g. a focus check, is shown whole; pictures of the same size keep the view for comparing
+                self._pyramid = None
+                self._zoom = None
+                self._shownBox = None
+                self._refreshFoto()
+                return
+            self._pyramid = TilePyramid(self._img)
+            self._tiles.clear()
+        pyramid = self._pyramid
+        w, h = self._viewSize()
+        width, height = self._img.size()
+        # keep at least part of the picture in view
+        self._center = (min(max(self._center[0], 0), width), min(max(self._center[1], 0), height))
+        zoom = self._zoom
+        level = min(TilePyramid.LEVELS - 1, max(0, int(round(-math.log2(zoom)))))
+        scale = zoom * 2**level
+        left = self._center[0] - w / 2 / zoom
+        top = self._center[1] - h / 2 / zoom
+        self._pic.delete('all')
+        self._pic.config(width=w, height=h)
+        # taken once, as a level loaded for another zoom on the worker may evict this one while the tiles are cut
+        level_img = pyramid.level(level)
+        if level_img is None:
+            fit = self._img.rendition(self._shownBox or self._displayBox())
+            f = fit.size[0] / width
+            region = fit.crop((int(left * f), int(top * f), int((left + w / zoom) * f), int((top + h / zoom) * f)))
+            img = ImageTk.PhotoImage(region.resize((w, h), Image.BILINEAR))
+            self._pic.create_image(0, 0, anchor='nw', image=img, tags='tile')
+            self._pic.image = img
+            self._worker.submit(lambda: pyramid.load(level), lambda res: self._drawTiles() if self._pyramid is pyramid else None,
+                                self._showError, key='level')
+        else:
+            size = TilePyramid.TILE * scale
+            columns, rows = pyramid.tileCount(level)
+            x0 = left * zoom
+            y0 = top * zoom
+            first_column, first_row = max(0, int(x0 // size)), max(0, int(y0 // size))
+            last_column, last_row = min(columns - 1, int((x0 + w) // size)), min(rows - 1, int((y0 + h) // size))
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    key = (level, scale, column, row)
+                    if key in self._tiles:
+                        self._tiles.move_to_end(key)
+                    else:
+                        tile = pyramid.cropTile(level_img, column, row)
+                        if scale != 1:
+                            tile = tile.resize((int(tile.size[0] * scale), int(tile.size[1] * scale)), Image.NEAREST)
+                        self._tiles[key] = ImageTk.PhotoImage(tile)
+                    self._pic.create_image(column * size - x0, row * size - y0, anchor='nw', image=self._tiles[key], tags='tile')
+            # the displayed tiles are smaller than TILE when zoomed out, and an evicted tile on screen would go blank
+            limit = 3 * (int(w // size) + 2) * (int(h // size) + 2)
+            while len(self._tiles) > limit:
+                self._tiles.popitem(last=False)
+        self._drawOverlay()
+        self._showPicFrame()
+
+    def _scheduleRefresh(self):
+        """
+        Refreshes the picture once the window has stopped resizing
+        """
+        if self._refreshAfter is not None:
+            self._root.after_cancel(self._refreshAfter)
+        self._refreshAfter = self._root.after(100, self._refreshFoto)
+
+    def _display(self, img):
+        """
+        Shows a PIL image in the picture frame
+        """
+        from PIL import ImageTk
+        self._shownSize = img.size
+        img = ImageTk.PhotoImage(img)
+        self._pic.delete('all')
+        self._pic.create_image(0, 0, anchor='nw', image=img, tags='img')
+        self._pic.config(width=self._shownSize[0], height=self._shownSize[1])
         self._pic.image = img
+        self._drawClipping()
+        self._drawOverlay()
+        self._showPicFrame()
+
+    def _showPicFrame(self):
+        """
+        Shows the picture frame instead of the settings, with the analysis panel and the filmstrip next to it
+        """
         self._picFrame.pack(fill='both', expand=1)
-        self._pic.pack(fill='both', expand=1)
+        self._pic.pack(side='left', fill='both', expand=1)
+        if self._showAnalysis and self._preview is None:
+            self._drawAnalysis()
+            self._panel.pack(side='right', fill='y', before=self._pic)
+        else:
+            self._panel.pack_forget()
+        if self._archive is not None and self._preview is None:
+            self._strip.pack(side='bottom', fill='x', before=self._picFrame)
+            self._drawStrip()
         self._settingsFrame.pack_forget()
 
     def run(self):
@@ -115,8 +972,17 @@ class RpiHqCamGui:
         Runs GUI. Note the RpiHqCamGui object is deleted after running this fcn.
         """
         self._constructSettings()
-        self._root.bind("<Return>", lambda event: self._getAndShowFoto(event))
-        self._root.bind('<Escape>', lambda event: self._showSettings())
+        self._root.bind('<Escape>', lambda event: self._toggleSettings())
+        self._root.bind('<F3>', lambda event: self._toggleOverlay())
+        self._root.bind('<F4>', lambda event: self._toggleAnalysis())
+        self._root.bind('<F6>', lambda event: self._toggleClipping())
+        # arrow keys still move the cursor while typing in the settings
+        self._root.bind('<Left>', lambda event: self._stepFrame(-1) if not isinstance(event.widget, ttk.Entry) else None)
+        self._root.bind('<Right>', lambda event: self._stepFrame(1) if not isinstance(event.widget, ttk.Entry) else None)
+        self._root.bind('<Home>', lambda event: self._stepFrame(-len(self._archive)) if self._archive is not None and not isinstance(event.widget, ttk.Entry) else None)
+        self._root.bind('<End>', lambda event: self._stepFrame(len(self._archive)) if self._archive is not None and not isinstance(event.widget, ttk.Entry) else None)
+        self._root.bind('<Configure>', lambda event: self._scheduleRefresh() if event.widget is self._root else None)
+        self._connect()
         self._root.mainloop()
         del self
 
@@ -128,7 +994,20 @@ if __name__ == '__main__':
     parser.add_argument('pswd', help='Password for RPi')
     parser.add_argument('user', help='Username for RPi')
     parser.add_argument('remote_dir', help='Workspace for this program')
+    parser.add_argument('--hot', action='store_true', help='Keep raspistill running between captures')
+    parser.add_argument('--stream', action='store_true', help='Pipe images over ssh instead of writing them to disk')
+    parser.add_argument('--keepalive', type=int, default=10, help='Seconds between keepalive packets, 0 to disable')
+    parser.add_argument('--compress', action='store_true', help='Compress the ssh transport, helps on a slow link')
+    parser.add_argument('--cipher', action='append', default=None, help='Allowed ssh cipher, e.g. aes128-ctr. Can be given several times')
+    parser.add_argument('--window', type=int, default=None, help='ssh window size in bytes')
+    parser.add_argument('--budget', type=float, default=None, help='Seconds within which a capture should be shown, adapting encoding to the link')
+    parser.add_argument('--lossy', action='store_true', help='Meet the budget by lowering quality and resolution instead of showing a thumbnail first')
+    parser.add_argument('--metrics', default=None, help='Append the stage timings of every capture to this JSON lines file')
+    parser.add_argument('--archive', default='captures', help='Directory all captures are kept in, browsable with the arrow keys')
+    parser.add_argument('--archive-size', type=int, default=2000, help='Megabytes the archive may take, the least recently viewed captures are deleted beyond it')
     args = parser.parse_args()    
-    cam = RpiHqCamGui(args.ip, args.user, args.pswd, args.remote_dir, log=True)
+    cam = RpiHqCamGui(args.ip, args.user, args.pswd, args.remote_dir, log=True, hot=args.hot, stream=args.stream, metrics=args.metrics,
+                      settings=SshSettings(keepalive=args.keepalive, compress=args.compress, ciphers=args.cipher, window_size=args.window),
+                      budget=args.budget, lossy=args.lossy, archive=args.archive, archive_size=args.archive_size * 10**6)
     cam.run()
 
@@ -0,0 +1,159 @@
+import threading
+import queue
+import traceback
+
+
+class Job:
+    """
+    A unit of work submitted to a Worker
+    """
+    def __init__(self, fn, on_done, on_error, key):
+        self.fn = fn
+        self.on_done = on_done
+        self.on_error = on_error
+        self.key = key
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancels the job. A job which is already running is allowed to finish but its result is dropped.
+        """
+        self.cancelled = True
+
+
+class Worker:
+    """
+    Class for running slow jobs (capture, transfer, decode) on a background thread.
+    Results are handed back to the Tk mainloop through a queue which is polled with after(),
+    so callbacks run on the main thread and are free to touch widgets.
+    """
+    def __init__(self, root, poll_ms=16, on_busy=None):
+        """
+        :param root:    Tk root used for polling the result queue
+        :param poll_ms: polling interval in milliseconds
+        :param on_busy: called on the main thread with True/False when the worker becomes busy/idle
+        """
+        self._root = root
+        self._poll_ms = poll_ms
+        self._on_busy = on_busy
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self._running = None
+        self._outstanding = 0
+        self._busy = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        self._after_id = self._root.after(self._poll_ms, self._poll)
+
+    def submit(self, fn, on_done=None, on_error=None, key=None):
+        """
+        Queues fn to be run on the worker thread.
+        Jobs with a key are coalesced: while a job with the same key is still waiting to start,
+        submitting another one returns the waiting job instead of queueing a new one.
+
+        :param fn:          callable run on the worker thread
+        :param on_done:     called on the main thread with the return value of fn
+        :param on_error:    called on the main thread with the exception raised by fn
+        :param key:         coalescing key
+        """
+        with self._lock:
+            if key is not None and key in self._waiting:
+                return self._waiting[key]
+            job = Job(fn, on_done, on_error, key)
+            if key is not None:
+                self._waiting[key] = job
+            self._outstanding += 1
+        self._jobs.put(job)
+        return job
+
+    def cancel(self):
+        """
+        Cancels all queued and running jobs
+        """
+        with self._lock:
+            self._waiting.clear()
+        for job in list(self._jobs.queue):
+            if job is not None:
+                job.cancel()
+        running = self._running
+        if running is not None:
+            running.cancel()
+
+    def busy(self):
+        """
+        True while jobs are queued or running
+        """
+        return self._outstanding > 0
+
+    def stop(self):
+        """
+        Stops polling and lets the worker thread exit once its current job is done
+        """
+        self._stopped = True
+        self.cancel()
+        self._jobs.put(None)
+        if self._after_id is not None:
+            self._root.after_cancel(self._after_id)
+            self._after_id = None
+
+    def _loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            with self._lock:
+                if self._waiting.get(job.key) is job:
+                    del self._waiting[job.key]
+            self._running = job
+            if job.cancelled:
+                res, err = None, None
+            else:
+                try:
+                    res, err = job.fn(), None
+                except Exception as e:
+                    res, err = None, e
+            self._running = None
+            self._results.put((job, res, err))
+
+    def _poll(self):
+        """
+        Hands finished jobs to their callbacks. A callback which raises is reported, and never stops the polling.
+        """
+        try:
+            while True:
+                try:
+                    job, res, err = self._results.get_nowait()
+                except queue.Empty:
+                    break
+                with self._lock:
+                    self._outstanding -= 1
+                if not job.cancelled:
+                    self._callback(job, res, err)
+            if self._busy != self.busy():
+                self._busy = self.busy()
+                if self._on_busy is not None:
+                    self._on_busy(self._busy)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if not self._stopped:
+                self._after_id = self._root.after(self._poll_ms, self._poll)
+
+    def _callback(self, job, res, err):
+        try:
+            if err is not None:
+                if job.on_error is not None:
+                    job.on_error(err)
+            elif job.on_done is not None:
+                job.on_done(res)
+        except Exception as e:
+            traceback.print_exc()
+            # an on_done which failed is reported like a failed job, e.g. in the status bar
+            if err is None and job.on_error is not None:
+                try:
+                    job.on_error(e)
+                except Exception:
+                    traceback.print_exc()
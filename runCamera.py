@@ -16,12 +16,19 @@ def piIsAvaliable(ip):
 
 class FotoHandler:
 
-    def __init__(self, ip, user, pswd, root):
+    def __init__(self, ip, user, pswd, root, port=22, ssh_options=''):
+        """
+        :param root:        Tk root to show fotos in, may be None when only taking fotos
+        :param port:        ssh port of the RPi
+        :param ssh_options: extra options passed to ssh and scp
+        """
         self._ip = ip
         self._user = user
         self._pswd = pswd
         self._root = root
-        self._label = Label(root, image="")
+        self._port = port
+        self._ssh_options = ssh_options
+        self._label = Label(root, image="") if root is not None else None
         self._img_path = os.path.join(os.path.dirname(__file__), 'image.jpeg')
         self._img = None
 
@@ -31,9 +38,9 @@ class FotoHandler:
         """
         image_name = os.path.split(self._img_path)[1]
         base = "sshpass -p '" + self._pswd + "' "
-        takepic = "ssh " + self._user + "@" + self._ip + " \"cd experiments; raspistill -o " + image_name
+        takepic = "ssh -p " + str(self._port) + " " + self._ssh_options + " " + self._user + "@" + self._ip + " \"cd experiments; raspistill -o " + image_name
         takepic += " -co 50 -br 30" + "\""
-        getpic = "scp " + self._user + "@" + self._ip + ":~/experiments/" + image_name + " " + self._img_path
+        getpic = "scp -P " + str(self._port) + " " + self._ssh_options + " " + self._user + "@" + self._ip + ":~/experiments/" + image_name + " " + self._img_path
         res = subprocess.run(base + takepic, shell=True)
         if res.returncode != 0:
             raise Exception("Could not take pic using RPi")
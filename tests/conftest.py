@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of this project live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,63 @@
+from Adaptive import AdaptiveController, Plan
+from Metrics import CaptureTimings
+
+
+def _controller():
+    controller = AdaptiveController(1.0, (1000, 1000), lossy=True)
+    controller._throughput = 1e6
+    controller._overhead = 0.1
+    controller._bpp = {None: 0.8}
+    return controller
+
+
+def test_camera_start_is_no_overhead():
+    controller = AdaptiveController(1.0, (1000, 1000))
+    timings = CaptureTimings()
+    timings.add('start', 2.0)
+    timings.add('remote', 0.1)
+    timings.add('transfer', 0.5)
+    timings.bytes = 500000
+    controller.record(timings, Plan())
+    assert controller._overhead == 0.1
+    assert controller._start == 2.0
+    assert controller._misses == 0
+
+
+def test_cheaper_plan_after_repeated_misses():
+    controller = _controller()
+    assert controller.plan().full()
+    # 1.1 s estimated, within the margin
+    controller._bpp[None] = 1.0
+    assert controller.plan().full()
+    controller._misses = AdaptiveController.PATIENCE
+    assert controller.plan().quality == 85
+    assert controller._misses == 0
+
+
+def test_cheaper_plan_right_away_beyond_margin():
+    controller = _controller()
+    controller.plan()
+    controller._bpp[None] = 1.5
+    assert not controller.plan().full()
+
+
+def test_richer_plan_has_to_pay_off_the_restart():
+    controller = _controller()
+    controller.plan()
+    controller._misses = AdaptiveController.PATIENCE
+    controller._bpp[None] = 1.0
+    assert controller.plan().quality == 85
+    # full quality would fit, but not with room for the restart
+    controller._bpp[None] = 0.6
+    controller._start = 0.5
+    assert controller.plan().quality == 85
+    controller._start = 0.05
+    assert controller.plan().full()
+
+
+def test_thumbnail_before_measuring_is_left_in_lossy_mode():
+    controller = _controller()
+    controller._throughput = None
+    assert controller.plan().thumbnail is not None
+    controller._throughput = 1e6
+    assert controller.plan().full()
@@ -0,0 +1,58 @@
+import io
+import os
+from PIL import Image
+from Archive import CaptureArchive
+
+
+def _jpeg(color):
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def test_eviction_keeps_newest(tmp_path):
+    data = _jpeg((200, 0, 0))
+    archive = CaptureArchive(str(tmp_path), max_bytes=2 * len(data) + 1)
+    for _ in range(4):
+        archive.add(data, options={'ISO': 100}, command='raspistill', mode='file')
+    assert len(archive) == 4
+    assert archive.path(0) is None
+    assert archive.path(1) is None
+    assert os.path.isfile(archive.path(3))
+    assert archive.diskUsage() == 2 * len(data)
+    # evicted frames keep their metadata and thumbnail
+    assert archive.frame(0)['evicted']
+    assert archive.frame(0)['options'] == {'ISO': 100}
+    assert archive.thumbnail(0)[:2] == b'\xff\xd8'
+
+
+def test_recently_used_survive(tmp_path):
+    data = _jpeg((0, 200, 0))
+    archive = CaptureArchive(str(tmp_path), max_bytes=2 * len(data) + 1)
+    archive.add(data)
+    archive.add(data)
+    archive.path(0)
+    archive.add(data)
+    assert archive.path(0) is not None
+    assert archive.path(1) is None
+
+
+def test_reload_from_index(tmp_path):
+    data = _jpeg((0, 0, 200))
+    archive = CaptureArchive(str(tmp_path), max_bytes=2 * len(data) + 1)
+    source = tmp_path / 'capture.jpeg'
+    source.write_bytes(data)
+    archive.add(str(source), mode='hot file')
+    archive.add(data)
+    archive.add(data)
+    with open(os.path.join(str(tmp_path), CaptureArchive.INDEX), 'a') as f:
+        # a line cut short by a crash
+        f.write('{"frame": 3, "ti')
+    reloaded = CaptureArchive(str(tmp_path), max_bytes=archive.max_bytes)
+    assert len(reloaded) == 3
+    assert reloaded.frame(0)['evicted']
+    assert reloaded.frame(0)['mode'] == 'hot file'
+    assert reloaded.path(0) is None
+    assert reloaded.path(2) is not None
+    assert reloaded.diskUsage() == 2 * len(data)
+    assert reloaded.add(data) == 3
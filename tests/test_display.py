@@ -0,0 +1,36 @@
+import io
+from PIL import Image
+from Display import CapturedImage, TilePyramid
+
+
+def _image(size=(1000, 600)):
+    buf = io.BytesIO()
+    Image.new('RGB', size, (10, 20, 30)).save(buf, 'JPEG')
+    return CapturedImage(buf.getvalue())
+
+
+def test_tiles():
+    pyramid = TilePyramid(_image())
+    assert pyramid.tile(0, 0, 0) is None
+    pyramid.load(0)
+    assert pyramid.tileCount(0) == (4, 3)
+    assert pyramid.tile(0, 0, 0).size == (TilePyramid.TILE, TilePyramid.TILE)
+    assert pyramid.tile(0, 3, 2).size == (1000 - 3 * TilePyramid.TILE, 600 - 2 * TilePyramid.TILE)
+    pyramid.load(1)
+    assert pyramid.level(1).size == (500, 300)
+
+
+def test_used_level_is_kept():
+    pyramid = TilePyramid(_image(), max_levels=2)
+    pyramid.load(0)
+    pyramid.load(1)
+    img = pyramid.level(0)
+    pyramid.load(2)
+    assert pyramid.level(0) is img
+    assert pyramid.level(1) is None
+    assert pyramid.tile(1, 0, 0) is None
+    pyramid.load(3)
+    # a level image taken before stays usable after its eviction
+    pyramid.load(1)
+    assert pyramid.level(0) is None
+    assert pyramid.cropTile(img, 1, 1).size == (TilePyramid.TILE, TilePyramid.TILE)
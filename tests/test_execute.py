@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+from Communication import RaspiStillCommClass
+from Metrics import CaptureTimings
+
+
+class _LateStdoutChannel:
+    """
+    A channel which has the exit status before its stdout, as OpenSSH may deliver them.
+    Without eof it is closed after the chunks, like a channel of a lost connection.
+    """
+    def __init__(self, chunks, gap=0.05, eof=True):
+        self._chunks = list(chunks)
+        self._gap = gap
+        self._due = time.time() + gap
+        self._eof = eof
+        self._closed = False
+        self.status_event = threading.Event()
+        self.status_event.set()
+        self._read, self._write = os.pipe()
+
+    @property
+    def eof_received(self):
+        return self._eof and not self._chunks
+
+    @property
+    def closed(self):
+        return self._closed or (not self._eof and not self._chunks)
+
+    def exec_command(self, command):
+        pass
+
+    def sendall(self, data):
+        pass
+
+    def shutdown_write(self):
+        pass
+
+    def fileno(self):
+        return self._read
+
+    def recv_ready(self):
+        return bool(self._chunks) and time.time() >= self._due
+
+    def recv(self, n):
+        self._due = time.time() + self._gap
+        return self._chunks.pop(0)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return 0
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            os.close(self._read)
+            os.close(self._write)
+
+
+class _Transport:
+    def __init__(self, channel):
+        self._channel = channel
+
+    def open_session(self):
+        return self._channel
+
+    def is_active(self):
+        return True
+
+
+class _Ssh:
+    def __init__(self, channel):
+        self._transport = _Transport(channel)
+
+    def get_transport(self):
+        return self._transport
+
+
+def test_stdout_after_exit_status():
+    cam = RaspiStillCommClass('127.0.0.1', 'pi', 'raspberry', 'experiments', connect=False)
+    cam._ssh = _Ssh(_LateStdoutChannel([b'a' * 100, b'b' * 100]))
+    try:
+        res = cam._execute('cat img.jpeg')
+    finally:
+        cam._ssh = None
+    assert res.stdout == b'a' * 100 + b'b' * 100
+    assert res.exit_status == 0
+
+
+def test_stream_capture_retried_from_scratch():
+    cam = RaspiStillCommClass('127.0.0.1', 'pi', 'raspberry', 'experiments', connect=False)
+    cam.settings.backoff = 0
+    cam._ssh = _Ssh(_LateStdoutChannel([b'partial'], eof=False))
+    cam.reconnect = lambda: setattr(cam, '_ssh', _Ssh(_LateStdoutChannel([b'a' * 100, b'b' * 100])))
+    timings = CaptureTimings('stream')
+    try:
+        data = cam._captureBytes('raspistill -o -', timings)
+    finally:
+        cam._ssh = None
+    assert data == b'a' * 100 + b'b' * 100
+    assert timings.bytes == 200
@@ -0,0 +1,44 @@
+import io
+import struct
+from PIL import Image
+from Communication import findJpegEnd
+import Raw
+
+
+def _jpeg(size=(64, 48), thumbnail=True):
+    buf = io.BytesIO()
+    Image.new('RGB', size, (120, 80, 40)).save(buf, 'JPEG')
+    data = buf.getvalue()
+    if thumbnail:
+        # an EXIF block holding a whole JPEG, with its own end of image marker, like raspistill writes
+        buf = io.BytesIO()
+        Image.new('RGB', (16, 12), (0, 0, 0)).save(buf, 'JPEG')
+        app1 = b'Exif\x00\x00' + buf.getvalue()
+        data = data[:2] + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + data[2:]
+    return data
+
+
+def test_findJpegEnd_skips_embedded_thumbnail():
+    data = _jpeg()
+    assert findJpegEnd(data) == len(data)
+    assert findJpegEnd(data + b'trailing') == len(data)
+
+
+def test_findJpegEnd_incomplete():
+    data = _jpeg()
+    assert findJpegEnd(data[:len(data) // 2]) == -1
+    assert findJpegEnd(data[:-1]) == -1
+
+
+def test_findJpegEnd_from_offset():
+    first, second = _jpeg(), _jpeg((32, 32), thumbnail=False)
+    data = first + second
+    assert findJpegEnd(data, len(first)) == len(data)
+
+
+def test_findRaw():
+    data = _jpeg()
+    assert Raw.findRaw(data) == -1
+    assert not Raw.hasRaw(data)
+    assert Raw.findRaw(data + b'BRCM' + bytes(64)) == len(data)
+    assert Raw.findRaw(b'not a jpeg') == -1
@@ -0,0 +1,39 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+from MotionHelper import ChangeDetector, FakeSource
+
+
+def _changes(script):
+    source = FakeSource(160, 120, 0, script)
+    detector = ChangeDetector(block=16, threshold=12)
+    source.start()
+    changes = []
+    while True:
+        frame = source.read()
+        if frame is None:
+            return changes
+        changes.append(detector.update(frame)[0])
+
+
+def test_still_scene_has_no_change():
+    assert max(_changes('still:20')) == 0.0
+
+
+def test_moving_square_is_a_change():
+    changes = _changes('still:10,move:3')
+    assert max(changes[:10]) == 0.0
+    assert min(changes[10:]) >= 0.01
+
+
+def test_reference_follows_the_scene():
+    detector = ChangeDetector(block=16, threshold=12, adapt=0.5)
+    frame = np.full((64, 64), 100, dtype=np.uint8)
+    detector.update(frame)
+    brighter = frame + 30
+    assert detector.update(brighter)[0] == 1.0
+    for _ in range(10):
+        detector.update(brighter)
+    assert detector.update(brighter)[0] == 0.0
+    detector.reset()
+    assert detector.update(frame) == (0.0, 0.0)
@@ -0,0 +1,27 @@
+import Options as op
+
+
+def test_int_option_accepts():
+    option = op.IntOption('-sh', 'sharpness', '', -100, 100, 0)
+    assert option.accepts(0)
+    assert option.accepts('-100')
+    assert not option.accepts(101)
+    assert not option.accepts('sharp')
+
+
+def test_generic_option_accepts():
+    option = op.GenericOption('-awb', 'awb', '', ['off', 'auto', 'sun'], 'auto')
+    assert option.accepts('sun')
+    assert not option.accepts('moon')
+    flag = op.FlagOption('-r', 'raw', '', 'off')
+    assert flag.accepts('on')
+    assert not flag.accepts('yes')
+    assert flag.getArguments() == ''
+    flag.value = 'on'
+    assert flag.getArguments() == '-r'
+
+
+def test_parseGrid():
+    assert op.parseGrid('ISO=100, 400,800; EV=-2,0,2') == {'ISO': ['100', '400', '800'], 'EV': ['-2', '0', '2']}
+    assert op.parseGrid(' awb ;') == {'awb': None}
+    assert op.parseGrid('') == {}
@@ -0,0 +1,67 @@
+"""
+Captures against Benchmark.StandIn, a local ssh/SFTP server with a fake raspistill
+"""
+import os
+import pytest
+
+pytest.importorskip('paramiko')
+from Benchmark import StandIn, syntheticJpeg, USER, PSWD
+from Communication import RaspiStillCommClass, findJpegEnd
+
+
+@pytest.fixture(scope='module')
+def standin():
+    standin = StandIn(syntheticJpeg((640, 480)))
+    yield standin
+    standin.close()
+
+
+@pytest.fixture
+def cam(standin, tmp_path):
+    cam = RaspiStillCommClass('127.0.0.1', USER, PSWD, 'experiments', port=standin.port, hot=True)
+    cam.local_dir = str(tmp_path)
+    yield cam
+    cam.stopHotCamera()
+    cam.close()
+
+
+def _assertJpeg(data):
+    assert data[:2] == b'\xff\xd8'
+    assert findJpegEnd(data) == len(data)
+
+
+def test_hot_capture(cam):
+    for _ in range(3):
+        cam.capture()
+        with open(cam.getCapturedImage(), 'rb') as f:
+            _assertJpeg(f.read())
+    assert cam.hotCameraRunning()
+    assert cam.last_timings.mode.startswith('hot file')
+
+
+def test_hot_stream_capture(cam):
+    cam.setStreaming(True)
+    for _ in range(3):
+        cam.capture()
+        _assertJpeg(cam.getCapturedImage().read())
+
+
+def test_burst(cam, tmp_path):
+    report = cam.burst(5, local_dir=str(tmp_path))
+    assert len(report.frames) == 5
+    assert not report.failed and report.dropped == 0
+    for pth in report.frames:
+        with open(pth, 'rb') as f:
+            _assertJpeg(f.read())
+
+
+def test_burst_schedule_starts_with_the_camera(tmp_path):
+    standin = StandIn(syntheticJpeg((320, 240)), startup_delay=1.0)
+    try:
+        cam = RaspiStillCommClass('127.0.0.1', USER, PSWD, 'experiments', port=standin.port)
+        report = cam.burst(4, interval=0.3, local_dir=str(tmp_path))
+        cam.close()
+    finally:
+        standin.close()
+    assert report.dropped == 0
+    assert len(report.frames) == 4